@@ -0,0 +1,109 @@
+import pickle
+import zipfile
+import collections
+import numpy as np
+
+# numpy dtypes of the torch storage types, stored little endian
+STORAGE_DTYPES = {
+    "DoubleStorage": "<f8",
+    "FloatStorage": "<f4",
+    "HalfStorage": "<f2",
+    "LongStorage": "<i8",
+    "IntStorage": "<i4",
+    "ShortStorage": "<i2",
+    "CharStorage": "i1",
+    "ByteStorage": "u1",
+    "BoolStorage": "?",
+}
+
+class StorageType(object):
+    """ stands in for a torch storage class, only remembers the dtype """
+    def __init__(self, name):
+        self.name = name
+
+class Storage(object):
+    """ reference to the storage record of a tensor in the archive, read only when needed """
+    def __init__(self, storage_type, key):
+        self.storage_type = storage_type
+        self.key = key
+
+class TensorRef(object):
+    """ a tensor that has not been read yet """
+    def __init__(self, storage, offset, size, stride):
+        self.storage = storage
+        self.offset = offset
+        self.size = tuple(size)
+        self.stride = tuple(stride)
+
+def rebuild_tensor(storage, storage_offset, size, stride, *args):
+    return TensorRef(storage, storage_offset, size, stride)
+
+def rebuild_parameter(data, *args):
+    return data
+
+class CheckpointUnpickler(pickle.Unpickler):
+    """
+    Unpickles the data.pkl record of a torch checkpoint without torch.
+    Tensors are returned as TensorRef, only the classes a state dict is made of are allowed.
+    """
+    def find_class(self, module, name):
+        if (module, name) == ("collections", "OrderedDict"):
+            return collections.OrderedDict
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return rebuild_tensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return rebuild_parameter
+        if module == "torch" and name in STORAGE_DTYPES:
+            return StorageType(name)
+        raise pickle.UnpicklingError(f"Unsupported class {module}.{name} in checkpoint")
+
+    def persistent_load(self, pid):
+        # ("storage", storage_type, key, location, numel)
+        if pid[0] != "storage":
+            raise pickle.UnpicklingError(f"Unsupported persistent id {pid[0]}")
+        return Storage(pid[1], pid[2])
+
+def read_tensor(archive, prefix, ref):
+    """
+    read the elements of a TensorRef from the archive into a numpy array.
+    Raises pickle.UnpicklingError when the offset, size and stride do not fit into the storage
+    """
+    if not isinstance(ref, TensorRef) or not isinstance(ref.storage, Storage) \
+            or not isinstance(ref.storage.storage_type, StorageType):
+        raise pickle.UnpicklingError("Expected a tensor in checkpoint")
+    dtype = np.dtype(STORAGE_DTYPES[ref.storage.storage_type.name])
+    data = np.frombuffer(archive.read(f"{prefix}/data/{ref.storage.key}"), dtype=dtype)
+    values = (ref.offset,) + ref.size + ref.stride
+    if len(ref.size) != len(ref.stride) or not all(isinstance(v, int) and v >= 0 for v in values):
+        raise pickle.UnpicklingError("Invalid tensor layout in checkpoint")
+    if 0 not in ref.size and ref.offset + sum((n - 1) * s for n, s in zip(ref.size, ref.stride)) >= len(data):
+        raise pickle.UnpicklingError("Tensor exceeds its storage in checkpoint")
+    strides = tuple(s * dtype.itemsize for s in ref.stride)
+    array = np.lib.stride_tricks.as_strided(data[ref.offset:], shape=ref.size, strides=strides)
+
+    return np.array(array, dtype=dtype.newbyteorder("="))
+
+def read_checkpoint(path, tensor="_submodules.0.weight"):
+    """
+    Read the fitness and a single tensor of the state dict from a genome checkpoint saved with torch.save,
+    without importing torch. Only the storage of the requested tensor is read from the archive.
+    Input:
+        path: path to the .pth file
+        tensor: name of the tensor in the state dict
+    Output:
+        Tuple of (numpy array, fitness), a fitness saved as a tensor is returned as a float
+    """
+    with zipfile.ZipFile(path) as archive:
+        record = next(name for name in archive.namelist() if name.endswith("/data.pkl"))
+        prefix = record[:-len("/data.pkl")]
+        with archive.open(record) as f:
+            layer = CheckpointUnpickler(f).load()
+        weights = read_tensor(archive, prefix, layer["state_dict"][tensor])
+        fitness = layer["fitness"]
+        if isinstance(fitness, TensorRef):
+            fitness = read_tensor(archive, prefix, fitness)
+            if fitness.size != 1:
+                raise pickle.UnpicklingError("Expected a scalar fitness in checkpoint")
+            fitness = fitness.item()
+
+    return weights, fitness
@@ -3,13 +3,9 @@ import numpy as np
 
 
 def centering(K):
-    n = K.shape[0]
-    unit = np.ones([n, n])
-    I = np.eye(n)
-    H = I - unit / n
-
-    return np.dot(np.dot(H, K), H)  # HKH are the same with KH, KH is the first centering, H(KH) do the second time, results are the sme with one time centering
-    # return np.dot(H, K)  # KH
+    # HKH with H = I - 1/n, written as subtracting the row and column means to avoid the O(n^3) products
+    K = np.asarray(K, dtype=float)
+    return K - K.mean(axis=0, keepdims=True) - K.mean(axis=1, keepdims=True) + K.mean()
 
 
 def rbf(X, sigma=None):
@@ -27,16 +23,80 @@ def kernel_HSIC(X, Y, sigma):
     return np.sum(centering(rbf(X, sigma)) * centering(rbf(Y, sigma)))
 
 
-def linear_HSIC(X, Y):
+def use_feature_space(n, d_x, d_y):
+    """
+    True if the d x d feature space form of linear HSIC is cheaper than the n x n sample space form.
+    Feature space costs O(n (d_x d_y + d_x^2 + d_y^2)), sample space O(n^2 (d_x + d_y)).
+    """
+    return d_x * d_y + d_x * d_x + d_y * d_y < n * (d_x + d_y)
+
+
+def linear_HSIC(X, Y, unbiased=False, space="auto"):
+    """
+    Linear HSIC, unnormalized like kernel_HSIC.
+    space: "sample" for the n x n Gram matrices, "feature" for ||Y^T X||_F^2 on centered columns,
+           "auto" picks the cheaper one from the shapes
+    unbiased: use the unbiased estimator of Song et al. (2012), needs more than 3 samples
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if space == "auto":
+        space = "feature" if use_feature_space(X.shape[0], X.shape[1], Y.shape[1]) else "sample"
+    if space not in ("sample", "feature"):
+        raise ValueError("Invalid space")
+    if unbiased:
+        return unbiased_linear_HSIC(X, Y, space)
+    if space == "feature":
+        X_c = X - X.mean(axis=0)
+        Y_c = Y - Y.mean(axis=0)
+        return np.sum(np.dot(Y_c.T, X_c) ** 2)
+
     L_X = np.dot(X, X.T)
     L_Y = np.dot(Y, Y.T)
     return np.sum(centering(L_X) * centering(L_Y))
 
 
-def linear_CKA(X, Y):
-    hsic = linear_HSIC(X, Y)
-    var1 = np.sqrt(linear_HSIC(X, X))
-    var2 = np.sqrt(linear_HSIC(Y, Y))
+def unbiased_linear_HSIC(X, Y, space="sample"):
+    """
+    Unbiased linear HSIC (Song et al., 2012) on the Gram matrices with a zeroed diagonal,
+    the feature space form expands every term into products of X^T Y, X^T 1 and the row norms.
+    """
+    n = X.shape[0]
+    if n <= 3:
+        raise ValueError("Unbiased HSIC needs more than 3 samples")
+    if space == "feature":
+        diag_X = np.sum(X * X, axis=1)
+        diag_Y = np.sum(Y * Y, axis=1)
+        sum_X = X.sum(axis=0)
+        sum_Y = Y.sum(axis=0)
+        trace = np.sum(np.dot(X.T, Y) ** 2) - np.dot(diag_X, diag_Y)
+        total_X = np.dot(sum_X, sum_X) - diag_X.sum()
+        total_Y = np.dot(sum_Y, sum_Y) - diag_Y.sum()
+        rows_X = np.dot(X, sum_X) - diag_X
+        rows_Y = np.dot(Y, sum_Y) - diag_Y
+    else:
+        K = np.dot(X, X.T)
+        L = np.dot(Y, Y.T)
+        np.fill_diagonal(K, 0)
+        np.fill_diagonal(L, 0)
+        trace = np.sum(K * L)
+        total_X = K.sum()
+        total_Y = L.sum()
+        rows_X = K.sum(axis=1)
+        rows_Y = L.sum(axis=1)
+
+    hsic = trace + total_X * total_Y / ((n - 1) * (n - 2)) - 2 * np.dot(rows_X, rows_Y) / (n - 2)
+    return hsic / (n * (n - 3))
+
+
+def linear_CKA(X, Y, unbiased=False, space="auto"):
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if space == "auto":
+        space = "feature" if use_feature_space(X.shape[0], X.shape[1], Y.shape[1]) else "sample"
+    hsic = linear_HSIC(X, Y, unbiased, space)
+    var1 = np.sqrt(linear_HSIC(X, X, unbiased, space))
+    var2 = np.sqrt(linear_HSIC(Y, Y, unbiased, space))
 
     return hsic / (var1 * var2)
 
@@ -49,12 +109,46 @@ def kernel_CKA(X, Y, sigma=None):
     return hsic / (var1 * var2)
 
 
+def kernel_representation(X, sigma=None):
+    """
+    Centered RBF kernel of X, the part of kernel_CKA that only depends on one of the inputs.
+    Can be computed once per matrix and reused with cka_from_representations.
+    """
+    return centering(rbf(X, sigma))
+
+
+def linear_representation(X):
+    """
+    Centered linear kernel of X, see kernel_representation
+    """
+    return centering(np.dot(X, X.T))
+
+
+def linear_feature_representation(X):
+    """
+    X with centered columns, the feature space counterpart of linear_representation.
+    The HSIC of two representations is ||Y_c^T X_c||_F^2.
+    """
+    X = np.asarray(X, dtype=float)
+    return X - X.mean(axis=0)
+
+
+def cka_from_representations(K_X, K_Y):
+    hsic = np.sum(K_X * K_Y)
+    var1 = np.sqrt(np.sum(K_X * K_X))
+    var2 = np.sqrt(np.sum(K_Y * K_Y))
+
+    return hsic / (var1 * var2)
+
+
 if __name__=='__main__':
     X = np.random.randn(100, 64)
     Y = np.random.randn(100, 64)
 
     print('Linear CKA, between X and Y: {}'.format(linear_CKA(X, Y)))
     print('Linear CKA, between X and X: {}'.format(linear_CKA(X, X)))
+    print('Linear CKA (feature space), between X and Y: {}'.format(linear_CKA(X, Y, space="feature")))
+    print('Unbiased linear CKA, between X and Y: {}'.format(linear_CKA(X, Y, unbiased=True)))
 
     print('RBF Kernel CKA, between X and Y: {}'.format(kernel_CKA(X, Y)))
     print('RBF Kernel CKA, between X and X: {}'.format(kernel_CKA(X, X)))
@@ -1,7 +1,179 @@
-from visualize import visualize_population, visualize_ensemble, visualize_pareto_front
-from utils import get_solutoins, load_solutions, save_ensemble, get_reference_solution, compute_distance, get_optimal_solution
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from quality import QualityTracker
+from screening import possibly_optimal, SketchScreen, CKA_METRICS
+from pareto import pareto_mask, bounded_front
+from utils import get_solutoins, load_solutions, save_ensemble, as_solution_set, DistanceCache, METRIC_LOWER_BOUNDS
 
-def construct_ensamble(solutions, k):
+class SelectionState(object):
+    """
+    The state of a greedy ensemble construction, one solution is added per step.
+    Keeps the minimum distance of every candidate to the ensemble, and the bounds on it when a screen is used,
+    together with the number of ensemble members already folded into them, so a construction can be
+    stopped and continued at any point.
+    """
+    def __init__(self, solutions, distances=None, screen=None, ids=None, trace=None, patience=None, tol=1e-3, max_front=None):
+        """
+        See construct_ensamble for the arguments
+        """
+        self.keys = list(solutions.keys())
+        self.solutions = as_solution_set(solutions)
+        self.distances = distances if distances is not None else DistanceCache(self.solutions)
+        self.screen = screen
+        self.max_front = max_front
+        self.front_stats = {} # epsilons of the last bounded front, see pareto.bounded_front
+        # Exact distance evaluations and the time spent on them and on the bounds of the screen
+        self.counts = {"pairs": 0, "exact": 0, "approximate": 0, "exact_time": 0.0, "screen_time": 0.0}
+
+        candidates = np.arange(len(self.solutions)) if ids is None else np.asarray(ids, dtype=int)
+        ref_id = int(candidates[np.argmax(self.solutions.fitness[candidates])]) # The reference solution is the best performing solution
+        self.ensemble = [ref_id]
+        self.candidates = candidates[candidates != ref_id]
+        self.fitness = self.solutions.fitness[self.candidates]
+        self.min_distances = np.full(len(self.candidates), np.inf)
+        self.refined = np.zeros(len(self.candidates), dtype=int) # ensemble members included in the exact minimum distance
+        self.lower = np.full(len(self.candidates), np.inf) # bounds on the minimum distances, only used with a screen
+        self.upper = np.full(len(self.candidates), np.inf)
+        self.bounded = 0 # ensemble members included in the bounds
+
+        self.tracker = None
+        self.plateaued = False
+        if trace is not None or patience is not None:
+            # Distances are bounded by the smallest distance of the metric, fitness by the worst solution
+            reference = (METRIC_LOWER_BOUNDS[self.distances.metric], float(np.min(self.solutions.fitness[np.append(self.candidates, ref_id)])))
+            self.tracker = QualityTracker(reference, trace, patience, tol)
+
+    def done(self):
+        """ True when no more solutions can be added """
+        return len(self.candidates) == 0 or self.plateaued
+
+    def result(self):
+        """ the ensemble so far, genome ids for a SolutionSet and keys for a dictionary """
+        return [self.keys[i] for i in self.ensemble]
+
+    def refine(self, positions, limit=None):
+        """
+        bring the exact minimum distance of the candidates at positions up to date with the ensemble
+        limit: maximum number of exact distances to evaluate, unlimited if None. The refinement stops
+               there, and a later call continues where it stopped
+        Output:
+            True if the candidates at positions are up to date
+        """
+        for m, member in enumerate(self.ensemble):
+            need = positions[self.refined[positions] <= m]
+            if len(need) == 0:
+                continue
+            if limit is not None:
+                if limit <= 0:
+                    return False
+                need = need[:limit]
+                limit -= len(need)
+            start = time.perf_counter()
+            np.minimum.at(self.min_distances, need, self.distances.row(member, self.candidates[need]))
+            self.counts["exact"] += len(need)
+            self.counts["exact_time"] += time.perf_counter() - start
+            self.refined[need] = m + 1
+
+        return bool(np.all(self.refined[positions] == len(self.ensemble)))
+
+    def update_bounds(self):
+        """ bring the bounds of the screen up to date with the ensemble """
+        for member in self.ensemble[self.bounded:]:
+            lower, upper = self.screen.bounds(member, self.candidates)
+            np.minimum(self.lower, lower, out=self.lower)
+            np.minimum(self.upper, upper, out=self.upper)
+        self.bounded = len(self.ensemble)
+
+    def screened(self, limit=None):
+        """
+        Refine the exact minimum distance of every candidate that could still be on the pareto front
+        given the bounds on the minimum distances from the screen.
+        The bounds of the screen always hold, so candidates that are ruled out are dominated by a candidate whose
+        exact distance is at least its lower bound. Refining the other candidates cannot bring them back,
+        and the front of the refined candidates is the exact pareto front.
+        limit: maximum number of exact distances to evaluate, see refine
+        Output:
+            Tuple of (candidate_distances, selectable), the exact distance where it is known and the middle of
+            the bounds otherwise, and a mask of the refined candidates that could be on the front.
+            None if the limit was reached before every candidate on the front was refined
+        """
+        # The partial exact minimum is an upper bound as well, the minimum only decreases with more members
+        exact = self.refined == len(self.ensemble)
+        lower = np.where(exact, self.min_distances, self.lower)
+        upper = np.where(exact, self.min_distances, np.minimum(self.upper, self.min_distances))
+
+        mask = possibly_optimal(lower, upper, self.fitness)
+        if not self.refine(np.flatnonzero(mask & ~exact), limit):
+            return None
+        exact |= mask
+
+        return np.where(exact, self.min_distances, (lower + upper) / 2), mask
+
+    def step(self, approximate=False, history=None, limit=None):
+        """
+        Add the next solution to the ensemble.
+        approximate: select on the bounds of the screen alone, without computing any exact distance
+        limit: maximum number of exact distances to evaluate, see refine. When it is reached no solution
+               is added, the distances computed so far are kept for the next step
+        Output:
+            False if no solution could be added
+        """
+        if self.done():
+            return False
+        start, exact_time = time.perf_counter(), self.counts["exact_time"]
+        if self.screen is not None:
+            self.update_bounds()
+
+        if approximate:
+            if self.screen is None:
+                raise ValueError("Approximate selection needs a screen")
+            candidate_distances = (self.lower + self.upper) / 2
+            selectable = np.ones(len(self.candidates), dtype=bool)
+            self.counts["approximate"] += 1
+        elif self.screen is None:
+            complete = self.refine(np.arange(len(self.candidates)), limit)
+            candidate_distances = self.min_distances
+            selectable = np.ones(len(self.candidates), dtype=bool)
+        else:
+            screened = self.screened(limit)
+            complete = screened is not None
+            if complete:
+                candidate_distances, selectable = screened
+        if self.screen is not None:
+            # Everything the screen adds on top of the exact distances
+            self.counts["screen_time"] += time.perf_counter() - start - (self.counts["exact_time"] - exact_time)
+        if not approximate and not complete:
+            return False
+        self.counts["pairs"] += len(self.candidates)
+
+        if self.tracker is not None:
+            self.tracker.update(len(self.ensemble), np.column_stack((candidate_distances, self.fitness)))
+            if self.tracker.plateaued():
+                self.plateaued = True
+                return False
+
+        # The first selectable candidate on the pareto front, in the order of the candidates
+        selectable = np.flatnonzero(selectable)
+        if self.max_front is None:
+            front = pareto_mask(candidate_distances[selectable], self.fitness[selectable])
+        else:
+            front = bounded_front(candidate_distances[selectable], self.fitness[selectable], self.max_front, self.front_stats)
+        optimal = selectable[np.argmax(front)]
+
+        #visualize_pareto_front(candidate_solutions, optimal_solutions, len(new_set))
+        if history is not None:
+            candidate_solutions = {self.keys[c]: (d, f) for c, d, f in zip(self.candidates, candidate_distances, self.fitness)}
+            history.append((self.result(), candidate_solutions, [self.keys[self.candidates[optimal]]]))
+
+        self.ensemble.append(int(self.candidates[optimal]))
+        self.candidates, self.fitness, self.min_distances, self.refined, self.lower, self.upper = (
+            np.delete(array, optimal) for array in
+            (self.candidates, self.fitness, self.min_distances, self.refined, self.lower, self.upper))
+
+        return True
+
+def construct_ensamble(solutions, k, history=None, trace=None, patience=None, tol=1e-3, distances=None, screen=None, stats=None, ids=None, max_front=None):
     """
     An iterative algorithm to construct an ensemble of k solutions from the given solutions.
     Uses the reference solution, which is the best performing solution, as the starting point.
@@ -9,41 +181,128 @@ def construct_ensamble(solutions, k):
         1. The largest minimum distance between candidate solutions and the solutions in the ensemble
         2. The fitness of the candidate solution
     The optimal solutions are selected from the pareto front of the candidate solutions
+    The minimum distances are updated incrementally, only the distances to the newly added solution are computed.
     Input:
-        solutions: dictionary of solutions
+        solutions: SolutionSet, or dictionary of solutions
             key: path to solution
             value: tuple of (weight_matrix, fitness)
         k: number of solutions to include in the ensemble
+        history: optional list, every iteration appends (ensemble, candidate_solutions, optimal_solutions)
+                 which can be rendered with visualize.animate_selection
+        trace: optional list, every iteration appends the hypervolume, spread and size of the candidate front
+        patience: stop before k solutions are selected when the hypervolume changed by less than
+                  a relative tol for patience iterations
+        distances: DistanceCache over the same solutions used to look up distances, allows sharing them
+                   between runs. A new Kernel CKA cache is used if None
+        screen: optional screening.SketchScreen, exact distances are then only computed for candidates
+                whose bounds could still put them on the pareto front
+        stats: optional dictionary, filled with the number of candidate/ensemble pairs, the number of
+               exact distances evaluated and the seconds spent on them, the seconds spent on the bounds of the screen,
+               the number of exact evaluations saved by the screen, and the estimated seconds saved. The estimate
+               prices the saved evaluations at the cost per pair of one exact row over all candidates, which is
+               timed separately and not cached, minus the time spent on the screen including its build time.
+               With a screen, stats cost this one extra exact row
+        ids: optional genome ids to select from, all solutions if None
+        max_front: optional maximum size of the pareto front the next solution is selected from. The front is
+                   thinned out with an epsilon archive, see pareto.bounded_front, stats then holds the
+                   epsilons of the last iteration
     Output:
-        List of k solutions to include in the ensemble
+        List of k solutions to include in the ensemble, genome ids for a SolutionSet and keys for a dictionary
     """
-    ref_key, ref_solution = get_reference_solution(solutions) # The reference solution is the best performing solution
-    included = {ref_key:True} # Hash table to keep track of already included solutions
-    new_set = [ref_key] # The new set of solutions
+    state = SelectionState(solutions, distances, screen, ids, trace, patience, tol, max_front)
+    pair_time = 0.0
+    if stats is not None and screen is not None and len(state.candidates) > 0:
+        if state.distances.metric in CKA_METRICS:
+            # The kernels are needed with and without the screen, they are not part of the price of a pair
+            state.distances.representations(np.append(state.candidates, state.ensemble[0]))
+        start = time.perf_counter()
+        state.distances.compute(state.ensemble[0], state.candidates)
+        pair_time = (time.perf_counter() - start) / len(state.candidates)
+    while len(state.ensemble) < k and state.step(history=history):
+        pass
 
-    while len(new_set) < k:
-        candidate_solutions = {}
-        for candidate_key in solutions.keys():
-            if candidate_key in included: continue
-            min_d = float("inf"); min_key = None
-            for solution_key in new_set:
-                distance = compute_distance(solutions[solution_key][0], solutions[candidate_key][0])
-                if distance < min_d:
-                    min_d = distance
-                    min_key = candidate_key
+    if stats is not None:
+        stats.update(state.counts)
+        stats.update(state.front_stats)
+        stats["saved"] = state.counts["pairs"] - state.counts["exact"]
+        stats["saved_time"] = 0.0
+        if screen is not None:
+            stats["saved_time"] = stats["saved"] * pair_time - state.counts["screen_time"] - screen.build_time
 
-            candidate_solutions[candidate_key] = (min_d, solutions[candidate_key][1])
+    return state.result()
 
-        optimal_solutions = get_optimal_solution(candidate_solutions, included, 1)
+def construct_ensamble_anytime(solutions, k, time_budget=None, max_evaluations=None, state=None, approximate_below=0.2, sketch=None, **kwargs):
+    """
+    Deadline bounded version of construct_ensamble.
+    Adds solutions until k are selected or the budget is used up. The evaluation budget is a hard cap,
+    a step that would exceed it stops refining and adds no solution. The time budget is checked between
+    iterations. When less than approximate_below of the budget is left and there is a screen, the remaining
+    solutions are selected on sketched distances alone (see screening.SketchScreen), as long as the bounds of
+    the last exact step cost less than its exact distances. Otherwise every step stays exact.
+    Input:
+        solutions: SolutionSet as returned by load_solutions, a dictionary of path -> (weight_matrix, fitness)
+                   is converted with as_solution_set
+        k: number of solutions to include in the ensemble
+        time_budget: wall-clock budget in seconds, unlimited if None, nothing is added if 0
+        max_evaluations: budget of exact distance evaluations, unlimited if None, nothing is added if 0.
+                         The time spent on the screen is charged as well, at the measured cost of an exact evaluation
+        state: SelectionState returned by an earlier call to continue from, solutions and kwargs are then ignored
+        approximate_below: fraction of the budget below which approximate selection is used
+        sketch: "int8" or "lowrank", builds a SketchScreen of this method before the first step when there is
+                no screen, its build time is charged to the budget. No screen is built if None
+        kwargs: distances, screen, ids, trace, patience, tol and max_front, see construct_ensamble
+    Output:
+        Tuple of (ensemble, finished, state), the ensemble selected so far, whether the construction finished,
+        and the state to pass back in to continue. state.counts["approximate"] is the number of solutions
+        that were selected approximately.
+    """
+    start = time.time()
+    if (time_budget is not None and time_budget < 0) or (max_evaluations is not None and max_evaluations < 0):
+        raise ValueError("The budgets must not be negative")
+    if state is None:
+        state = SelectionState(solutions, **kwargs)
+    if time_budget == 0 or max_evaluations == 0:
+        return state.result(), len(state.ensemble) >= k or state.done(), state
+    counts = dict(state.counts)
+    build_time = 0.0
+    if sketch is not None and state.screen is None:
+        state.screen = SketchScreen(state.solutions, state.distances, sketch)
+        build_time = state.screen.build_time
 
-        #visualize_pareto_front(candidate_solutions, optimal_solutions, len(new_set))
+    def spent():
+        """ exact evaluations spent, including the time spent on the screen """
+        evaluations = state.counts["exact"] - counts["exact"]
+        if state.counts["exact"] > 0:
+            evaluation_time = state.counts["exact_time"] / state.counts["exact"]
+            evaluations += (state.counts["screen_time"] - counts["screen_time"] + build_time) / evaluation_time
+        return evaluations
 
-        for key in optimal_solutions:
-            new_set.append(key)
-            included[key] = True
+    def remaining():
+        """ fraction of the tightest budget that is left """
+        left = 1.0
+        if time_budget is not None:
+            left = min(left, 1 - (time.time() - start) / time_budget)
+        if max_evaluations is not None:
+            left = min(left, 1 - spent() / max_evaluations)
+        return left
 
-    return new_set
+    # Cost of the exact distances and of the bounds in the last exact step
+    exact_cost, screen_cost = 0.0, np.inf
+    while len(state.ensemble) < k and not state.done():
+        left = remaining()
+        if left <= 0:
+            break
+        approximate = state.screen is not None and left < approximate_below and screen_cost < exact_cost
+        limit = None if max_evaluations is None else int(max_evaluations - spent())
+        before = dict(state.counts)
+        if not state.step(approximate, limit=limit):
+            break
+        if not approximate:
+            exact_cost = state.counts["exact_time"] - before["exact_time"]
+            screen_cost = state.counts["screen_time"] - before["screen_time"]
 
+    finished = len(state.ensemble) >= k or state.done()
+    return state.result(), finished, state
 
 def generate_ensemble(root_dir, dst, generation_st, generation_end, k):
     """
@@ -58,9 +317,73 @@ def generate_ensemble(root_dir, dst, generation_st, generation_end, k):
     solution_paths = get_solutoins(root_dir, generation_st, generation_end)
     solutions = load_solutions(solution_paths)
     ensemble = construct_ensamble(solutions, k)
+    # matplotlib and sklearn are only needed for the plots
+    from visualize import visualize_population, visualize_ensemble
     visualize_population(solutions)
     visualize_ensemble(solutions, ensemble)
-    save_ensemble(ensemble, dst)
+    save_ensemble([solutions.paths[i] for i in ensemble], dst)
+
+
+def _sweep_group(solutions, ids, generation_st, generation_end, metric, ks, distances):
+    """
+    Run a single greedy pass to the largest k and report every requested k-prefix
+    """
+    trace = []
+    ensemble = construct_ensamble(solutions, max(ks), trace=trace, distances=distances, ids=ids)
+    quality = {record["iteration"]: record for record in trace}
+
+    results = []
+    for k in sorted(ks):
+        prefix = ensemble[:k]
+        pair_distances = np.concatenate([distances.row(prefix[i], prefix[i + 1:]) for i in range(len(prefix))])
+        result = {
+            "generation_st": generation_st,
+            "generation_end": generation_end,
+            "metric": metric,
+            "k": k,
+            "ensemble": [solutions.paths[i] for i in prefix],
+            "mean_fitness": float(np.mean(solutions.fitness[prefix])),
+            "mean_distance": float(np.mean(pair_distances)) if len(pair_distances) else 0.0,
+        }
+        # Front quality of the candidates the k-th member was picked from
+        if k - 1 in quality:
+            result.update({name: quality[k - 1][name] for name in ("hypervolume", "spread", "front_size")})
+        results.append(result)
+
+    return results
+
+def sweep_ensembles(root_dir, generation_ranges, metrics, ks, workers=None):
+    """
+    Constructs ensembles for every combination of generation range, metric and k.
+    The population is loaded once and the distances are shared between all configurations using the same metric.
+    Greedy selection is prefix-nested, so a single pass to the largest k gives the ensembles of every smaller k.
+    Independent (generation range, metric) passes run in a thread pool.
+    Input:
+        root_dir: root directory of the solutions
+        generation_ranges: list of (generation_st, generation_end) tuples
+        metrics: list of distance metrics, see compute_distance
+        ks: list of ensemble sizes
+        workers: number of threads, defaults to the ThreadPoolExecutor default
+    Output:
+        List of dictionaries, one per configuration, with the ensemble paths and its metrics
+    """
+    range_paths = {(st, end): get_solutoins(root_dir, st, end) for st, end in generation_ranges}
+    all_paths = list(dict.fromkeys(path for paths in range_paths.values() for path in paths))
+    all_solutions = load_solutions(all_paths)
+    caches = {metric: DistanceCache(all_solutions, metric) for metric in metrics}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for (st, end), paths in range_paths.items():
+            ids = all_solutions.ids_of(paths)
+            for metric in metrics:
+                futures.append(executor.submit(_sweep_group, all_solutions, ids, st, end, metric, ks, caches[metric]))
+
+        results = []
+        for future in futures:
+            results.extend(future.result())
+
+    return results
 
 
 # Testing
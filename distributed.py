@@ -0,0 +1,399 @@
+import os
+import sys
+import time
+import json
+import hmac
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+import numpy as np
+from utils import DistanceCache, compute_distances, compute_distance_map, get_solutoins, load_solutions
+from cka import kernel_representation, linear_representation
+
+# A message is a JSON header followed by the raw buffers of its numpy arrays. Nothing received is ever
+# unpickled or executed, arrays are rebuilt with np.frombuffer from the dtype and shape in the header.
+HEADER = struct.Struct("!Q")
+MAX_HEADER = 1 << 20
+MAX_PAYLOAD = 1 << 32
+ARRAY_KINDS = "biuf" # numeric dtypes only, object arrays cannot be sent
+
+def send_message(sock, message):
+    """ send a dictionary of JSON values and numpy arrays """
+    fields = {}
+    arrays = []
+    buffers = []
+    for name, value in message.items():
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            if value.dtype.kind not in ARRAY_KINDS:
+                raise ValueError(f"Cannot send {value.dtype} arrays")
+            arrays.append({"name": name, "dtype": value.dtype.str, "shape": list(value.shape)})
+            buffers.append(value.tobytes())
+        else:
+            fields[name] = value
+    header = json.dumps({"fields": fields, "arrays": arrays}).encode()
+    sock.sendall(HEADER.pack(len(header)) + header + b"".join(buffers))
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def recv_message(sock):
+    """
+    receive a message sent with send_message
+    Output:
+        dictionary of the JSON values and numpy arrays, raises ValueError for a malformed message
+    """
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if size > MAX_HEADER:
+        raise ValueError("Message header too large")
+    header = json.loads(recv_exactly(sock, size))
+    if not isinstance(header, dict) or not isinstance(header.get("fields"), dict) or not isinstance(header.get("arrays"), list):
+        raise ValueError("Malformed message header")
+
+    message = dict(header["fields"])
+    for spec in header["arrays"]:
+        try:
+            dtype = np.dtype(spec["dtype"])
+            shape = tuple(int(n) for n in spec["shape"])
+            name = str(spec["name"])
+        except (KeyError, TypeError):
+            raise ValueError("Malformed array header")
+        if dtype.kind not in ARRAY_KINDS or any(n < 0 for n in shape):
+            raise ValueError("Invalid array in message")
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        if nbytes > MAX_PAYLOAD:
+            raise ValueError("Message payload too large")
+        message[name] = np.frombuffer(recv_exactly(sock, nbytes), dtype=dtype).reshape(shape)
+
+    return message
+
+class Tile(object):
+    """ block of the distance matrix, the distances between the rows ids and the cols ids """
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.ids = np.union1d(rows, cols)
+        self.attempts = 0
+        self.result = None
+        self.error = None
+
+class Coordinator(object):
+    """
+    Hands out tiles of the pairwise distance matrix to worker processes connected over TCP.
+    Workers keep the weight matrices they have received, tiles are preferably given to the worker
+    that already holds most of their genomes, and only the missing weight matrices are sent along.
+    A tile is requeued when its worker disconnects or times out, up to max_retries times.
+    Tiles are computed by the coordinator itself when no worker is connected, or when the workers
+    made no progress on them for local_after seconds.
+    Messages carry no code, see send_message. Any client that can reach the port can still join as a
+    worker and receive genomes, pass a shared secret when binding to an address other than localhost.
+    """
+    def __init__(self, solutions, metric="Kernel CKA", host="127.0.0.1", port=8766, tile_size=256,
+                 max_retries=3, task_timeout=60.0, local_after=30.0, secret=None):
+        """
+        solutions: SolutionSet of the genomes, the ids are shared with the workers
+        metric: distance metric, see compute_distance
+        port: port to listen on, 0 picks a free port, see self.address
+        tile_size: number of rows or columns of a tile
+        secret: string the workers must present when they connect, any worker is accepted if None
+        """
+        self.solutions = solutions
+        self.metric = metric
+        self.tile_size = tile_size
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        self.local_after = local_after
+        self.pending = []   # tiles waiting for a worker
+        self.workers = set() # names of the connected workers
+        self.condition = threading.Condition()
+        self.local = DistanceCache(solutions, metric) # fallback when no worker is available
+        self.secret = secret
+        self.completed = 0 # number of tiles finished
+        self.closed = False
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.address = self.server.getsockname()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while not self.closed:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve_worker, args=(sock,), daemon=True).start()
+
+    def next_tile(self, held):
+        """ pop the pending tile that shares the most genomes with the worker, waits for one to arrive """
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            best = max(range(len(self.pending)),
+                       key=lambda t: np.count_nonzero(np.isin(self.pending[t].ids, held)))
+            return self.pending.pop(best)
+
+    def finish(self, tile, result=None, error=None):
+        with self.condition:
+            tile.result = result
+            tile.error = error
+            if result is not None:
+                self.completed += 1
+            self.condition.notify_all()
+
+    def requeue(self, tile, reason):
+        with self.condition:
+            tile.attempts += 1
+            if tile.attempts > self.max_retries:
+                tile.error = f"Tile failed {tile.attempts} times, last error: {reason}"
+            else:
+                self.pending.append(tile)
+            self.condition.notify_all()
+
+    def serve_worker(self, sock):
+        """ feed tiles to a single worker until it disconnects """
+        sock.settimeout(self.task_timeout)
+        try:
+            hello = recv_message(sock)
+            name = str(hello["worker"])
+            if self.secret is not None and not hmac.compare_digest(str(hello.get("secret")), self.secret):
+                raise ValueError("Invalid secret")
+        except (OSError, ConnectionError, ValueError, KeyError):
+            sock.close()
+            return
+        with self.condition:
+            self.workers.add(name)
+        print(f"Worker {name} connected")
+
+        held = np.zeros(0, dtype=int)
+        tile = None
+        try:
+            while True:
+                tile = self.next_tile(held)
+                if tile is None:
+                    break
+                missing = np.setdiff1d(tile.ids, held)
+                send_message(sock, {"metric": self.metric, "rows": tile.rows, "cols": tile.cols,
+                                    "ids": missing, "weights": self.solutions.weights[missing]})
+                reply = recv_message(sock)
+                held = np.union1d(held, missing)
+                if "error" in reply:
+                    self.requeue(tile, str(reply["error"]))
+                elif np.shape(reply.get("distances")) != (len(tile.rows), len(tile.cols)):
+                    raise ValueError("Invalid tile result")
+                else:
+                    self.finish(tile, reply["distances"])
+                tile = None
+        except (OSError, ConnectionError, ValueError) as e:
+            print(f"Lost worker {name}: {e}")
+            if tile is not None:
+                self.requeue(tile, str(e))
+        finally:
+            with self.condition:
+                self.workers.discard(name)
+            sock.close()
+
+    def compute(self, rows, cols):
+        """
+        Distances between the rows ids and the cols ids, split into tiles and computed by the workers
+        Output:
+            len(rows) x len(cols) numpy array
+        """
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        tiles = [Tile(rows[r:r + self.tile_size], cols[c:c + self.tile_size])
+                 for r in range(0, len(rows), self.tile_size) for c in range(0, len(cols), self.tile_size)]
+        return self.compute_tiles(tiles, rows, cols)
+
+    def compute_tiles(self, tiles, rows, cols):
+        """ schedule the tiles and assemble their results into a len(rows) x len(cols) array """
+        with self.condition:
+            self.pending.extend(tiles)
+            self.condition.notify_all()
+
+        ours = set(id(tile) for tile in tiles)
+        last_progress = time.time()
+        remaining = len(tiles)
+        while True:
+            local = None
+            with self.condition:
+                unfinished = sum(tile.result is None and tile.error is None for tile in tiles)
+                if unfinished == 0:
+                    break
+                if unfinished < remaining:
+                    remaining = unfinished
+                    last_progress = time.time()
+                waiting = [tile for tile in self.pending if id(tile) in ours]
+                if waiting and (not self.workers or time.time() - last_progress > self.local_after):
+                    local = waiting[0]
+                    self.pending.remove(local)
+                else:
+                    self.condition.wait(timeout=1.0)
+            if local is not None:
+                # Nobody can pick this tile up, compute it here
+                self.finish(local, np.stack([self.local.compute(i, local.cols) for i in local.rows]))
+
+        result = np.full((len(rows), len(cols)), np.nan)
+        row_index = {i: r for r, i in enumerate(rows)}
+        col_index = {j: c for c, j in enumerate(cols)}
+        for tile in tiles:
+            if tile.error is not None:
+                raise RuntimeError(tile.error)
+            result[np.ix_([row_index[i] for i in tile.rows], [col_index[j] for j in tile.cols])] = tile.result
+
+        return result
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.close()
+
+class RemoteDistanceCache(DistanceCache):
+    """
+    DistanceCache whose missing distances are computed by the workers of a Coordinator.
+    The cache is the shared store the tile results are written into.
+    """
+    def __init__(self, solutions, coordinator):
+        super(RemoteDistanceCache, self).__init__(solutions, coordinator.metric)
+        self.coordinator = coordinator
+
+    def compute(self, i, ids):
+        return self.coordinator.compute([i], ids)[0]
+
+    def prefetch(self, ids=None):
+        """
+        Compute every distance between the solutions ids in one distributed batch,
+        only the tiles on and above the diagonal are scheduled.
+        """
+        ids = np.arange(len(self.solutions)) if ids is None else np.asarray(ids, dtype=int)
+        size = self.coordinator.tile_size
+        blocks = [ids[b:b + size] for b in range(0, len(ids), size)]
+        tiles = [Tile(blocks[r], blocks[c]) for r in range(len(blocks)) for c in range(r, len(blocks))]
+        distances = self.coordinator.compute_tiles(tiles, ids, ids)
+        distances = np.where(np.isnan(distances), distances.T, distances)
+        for r, i in enumerate(ids):
+            self.row(i, [])
+            self.rows[int(i)][ids] = distances[r]
+
+class WorkerStore(object):
+    """ the weight matrices a worker has received, and their kernel representations """
+    def __init__(self):
+        self.weights = {}
+        self.kernels = {}
+
+    def add(self, ids, weights):
+        for i, mat in zip(ids, weights):
+            self.weights[int(i)] = mat
+
+    def kernel(self, i, metric):
+        kernel = self.kernels.get(i)
+        if kernel is None:
+            if metric == "Kernel CKA":
+                kernel = kernel_representation(self.weights[i])
+            else:
+                kernel = linear_representation(self.weights[i])
+            self.kernels[i] = kernel
+        return kernel
+
+    def distances(self, rows, cols, metric):
+        """ len(rows) x len(cols) distances, computed like DistanceCache.compute """
+        if metric in ("Kernel CKA", "Linear CKA"):
+            kernels = np.stack([self.kernel(int(j), metric) for j in cols])
+            norms = np.sqrt(np.sum(kernels * kernels, axis=(1, 2)))
+            result = []
+            for i in rows:
+                kernel = self.kernel(int(i), metric)
+                result.append(np.sum(kernels * kernel, axis=(1, 2)) / (norms * np.sqrt(np.sum(kernel * kernel))))
+            return np.stack(result)
+        mats = np.stack([self.weights[int(j)] for j in cols])
+        return np.stack([compute_distances(self.weights[int(i)], mats, metric) for i in rows])
+
+def run_worker(host="127.0.0.1", port=8766, name=None, secret=None):
+    """
+    Connect to a coordinator and compute the tiles it sends until the connection is closed
+    """
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    store = WorkerStore()
+    with socket.create_connection((host, port)) as sock:
+        send_message(sock, {"worker": name, "secret": secret})
+        while True:
+            try:
+                task = recv_message(sock)
+            except ConnectionError:
+                return
+            try:
+                store.add(task["ids"], task["weights"])
+                send_message(sock, {"distances": store.distances(task["rows"], task["cols"], task["metric"])})
+            except (KeyError, TypeError, ValueError) as e:
+                send_message(sock, {"error": str(e)})
+
+def self_test(root_dir, generation_st, generation_end, metric="Kernel CKA", n_workers=3, tile_size=32, timeout=120.0):
+    """
+    Compute the distance map of a population with a coordinator and n_workers worker processes on localhost,
+    kill one worker while tiles are in flight, and compare the result to compute_distance_map
+    Output:
+        True if the distances match
+    """
+    solutions = load_solutions(get_solutoins(root_dir, generation_st, generation_end))
+    coordinator = Coordinator(solutions, metric, port=0, tile_size=tile_size, local_after=timeout)
+    port = coordinator.address[1]
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--port", str(port), "--name", f"worker-{w}"])
+               for w in range(n_workers)]
+    try:
+        deadline = time.time() + timeout
+        while len(coordinator.workers) < n_workers:
+            if time.time() > deadline:
+                raise RuntimeError("Workers did not connect")
+            time.sleep(0.1)
+
+        cache = RemoteDistanceCache(solutions, coordinator)
+        prefetch = threading.Thread(target=cache.prefetch)
+        prefetch.start()
+        while coordinator.completed == 0 and prefetch.is_alive():
+            time.sleep(0.01)
+        workers[0].kill()
+        print(f"Killed worker-0 after {coordinator.completed} tiles")
+        prefetch.join()
+
+        distances = compute_distance_map(solutions, metric=metric, distances=cache)
+        expected = compute_distance_map(solutions, metric=metric)
+        matches = bool(np.allclose(distances, expected, rtol=1e-6, atol=1e-9))
+        print(f"{len(solutions)} genomes, {coordinator.completed} tiles, distances match: {matches}")
+        return matches
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distance worker, computes distance tiles for a coordinator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--secret", default=None, help="shared secret of the coordinator")
+    parser.add_argument("--self-test", action="store_true",
+                        help="run a coordinator and --workers local workers on the test populations and check the result")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--root-dir", default="./test_populations/")
+    parser.add_argument("--metric", default="Kernel CKA")
+    args = parser.parse_args()
+
+    if args.self_test:
+        sys.exit(0 if self_test(args.root_dir, 0, 1, args.metric, args.workers) else 1)
+    run_worker(args.host, args.port, args.name, args.secret)
@@ -1,6 +1,7 @@
 import sys
 import math
 import argparse
+import numpy as np
 
 def rerange(intranges):
     """ convert a set of intranges into a list of integers """
@@ -62,16 +63,29 @@ class Archive(object):
     The eps_sort function provides a much more convenient interface than
     the Archive class.
     """
-    def __init__(self, epsilons):
+    def __init__(self, epsilons, max_size=None, growth=1.1):
         """
         epsilons: sizes of epsilon boxes to use in the sort.  Number
                   of objectives is inferred by the number of epsilons.
+        max_size: maximum number of solutions in the archive.  When it
+                  is exceeded the epsilons are coarsened and the archive
+                  is re-binned, see coarsen.  No limit if None.
+        growth:   smallest factor by which the coarsening scale grows
+                  from one coarsening to the next, see coarsen
         """
+        if max_size is not None and max_size < 1:
+            raise SortParameterError("max_size must be at least 1")
+        if growth <= 1:
+            raise SortParameterError("growth must be larger than 1")
         self.archive = []       # objectives
         self.tagalongs = []     # tag-along data
         self.boxes = []         # remember for efficiency
-        self.epsilons = epsilons
+        self.epsilons = list(epsilons)
         self.itobj = range(len(epsilons)) # infer number of objectives
+        self.max_size = max_size
+        self.growth = growth
+        self.coarsenings = 0    # number of times the epsilons were coarsened
+        self.scale = 0.0        # coarsening scale of the last coarsening
 
     def add(self, objectives, tagalong, ebox):
         """ add a solution to the archive, plus auxiliary information """
@@ -88,7 +102,70 @@ class Archive(object):
     def sortinto(self, objectives, tagalong=None):
         """
         Sort a solution into the archive.  Add it if it's nondominated
-        w.r.t current solutions.
+        w.r.t current solutions.  Coarsens the epsilons if the archive
+        grows beyond max_size.
+
+        objectives: objectives by which to sort.  Minimization is assumed.
+        tagalong:   data to preserve with the objectives, see insert.
+        """
+        self.insert(objectives, tagalong)
+        if self.max_size is not None and len(self.archive) > self.max_size:
+            self.coarsen()
+
+    def coarsen(self):
+        """
+        Grow the epsilon boxes just enough for the archive to fit into
+        max_size and re-bin the archive members.  The epsilons are
+        max(epsilon, scale * extent) for the extent of the archive along
+        each objective, and the smallest fitting scale is found by
+        bisection on the number of nondominated boxes, see
+        box_front_size.  The scale grows at least by the growth factor
+        from one coarsening to the next, so a sort only coarsens a few
+        times.  When even boxes larger than the objectives cannot fit
+        the archive, which can happen for a max_size of 1, the archive
+        keeps the few boxes that are left.
+        """
+        objectives = np.array(self.archive, dtype=float)
+        epsilons = np.array(self.epsilons, dtype=float)
+        extent = objectives.max(axis=0) - objectives.min(axis=0)
+        limit = np.abs(objectives).max(axis=0)
+
+        def scaled(scale):
+            return np.maximum(epsilons, scale * extent)
+
+        def fits(scale):
+            return box_front_size(objectives, scaled(scale)) <= self.max_size
+
+        low = self.scale
+        high = self.scale * self.growth
+        if not fits(high):
+            low = high
+            high = max(high, 1.0 / self.max_size)
+            # Past the objectives every box holds only their sign
+            while not fits(high) and np.any((scaled(high) <= limit) & (extent > 0)):
+                low, high = high, high * 2
+            while high - low > 1e-3 * high:
+                middle = (low + high) / 2
+                if fits(middle):
+                    high = middle
+                else:
+                    low = middle
+
+        self.scale = high
+        self.epsilons = [float(eps) for eps in scaled(high)]
+        self.coarsenings += 1
+
+        members = list(zip(self.archive, self.tagalongs))
+        self.archive = []
+        self.tagalongs = []
+        self.boxes = []
+        for objectives, tagalong in members:
+            self.insert(objectives, tagalong)
+
+    def insert(self, objectives, tagalong=None):
+        """
+        Sort a solution into the archive with the current epsilons,
+        regardless of max_size.
 
         objectives: objectives by which to sort.  Minimization is assumed.
         tagalong:   data to preserve with the objectives.  Probably the actual
@@ -321,6 +398,8 @@ def eps_sort(tables, objectives=None, epsilons=None, **kwargs):
     *maximize*      columns to maximize
     *maximize_all*  maximize all columns
     *attribution*   True: add table number, row number to rows
+    *max_size*      maximum archive size, see eps_sort_solutions
+    *stats*         dictionary to report the final epsilons in
 
     Duplicates some of cli() for a programmatic interface
     """
@@ -352,15 +431,20 @@ def eps_sort(tables, objectives=None, epsilons=None, **kwargs):
         tables = [maximize(solutions, mindices) for solutions in tables]
 
     # tagalongs is the *raw* data
-    tagalongs = eps_sort_solutions(tables, epsilons)
+    tagalongs = eps_sort_solutions(tables, epsilons, kwargs.get("max_size"),
+                                   kwargs.get("stats"))
 
     return tagalongs
 
-def eps_sort_solutions(tables, epsilons=None):
+def eps_sort_solutions(tables, epsilons=None, max_size=None, stats=None):
     """
     Perform an epsilon-nondominated sort
     tables: input (objectives, row) tuples
     epsilons: epsilon values for the objectives.  Assume 1e-9 if none
+    max_size: maximum size of the archive, the epsilons are coarsened
+              when it is exceeded.  No limit if None
+    stats: dictionary to report the final "epsilons" and the number of
+           "coarsenings" in, ignored if None
     """
     # slip the first row off the first table to figure out nobj
     objectives, row = next(tables[0])
@@ -374,12 +458,16 @@ def eps_sort_solutions(tables, epsilons=None):
         msg = "{0} epsilons, but {1} objectives".format(len(epsilons), nobj)
         raise SortParameterError(msg)
 
-    archive = Archive(epsilons)
+    archive = Archive(epsilons, max_size)
 
     for table in tables:
         for objectives, row in table:
             archive.sortinto(objectives, row)
 
+    if stats is not None:
+        stats["epsilons"] = list(archive.epsilons)
+        stats["coarsenings"] = archive.coarsenings
+
     return archive.tagalongs
 
 def attribution(stream, tags, number=False):
@@ -486,7 +574,17 @@ def list_to_string(inp):
 
     return string
 
-def compute_pareto(inp):
+def compute_pareto(inp, max_size=None, stats=None):
+    """
+    Compute the epsilon-nondominated front of (distance, fitness) pairs,
+    both objectives are maximized.
+    inp: list of (distance, fitness) or dictionary of tag -> (distance, fitness)
+    max_size: maximum size of the front, the epsilons start at 1e-9 and
+              are coarsened as needed to keep the front within max_size.
+              No limit if None
+    stats: dictionary to report the final "epsilons" and the number of
+           "coarsenings" in, ignored if None
+    """
     if type(inp) is list:
         inp = list_to_string(inp)
         tables = [noattribution(inp)]
@@ -509,6 +607,100 @@ def compute_pareto(inp):
     mindices = None
     tables = [maximize(solutions, mindices) for solutions in tables]
 
-    tagalongs = eps_sort_solutions(tables, [1e-9, 1e-9])
+    tagalongs = eps_sort_solutions(tables, [1e-9, 1e-9], max_size, stats)
 
     return tagalongs
+
+def pareto_mask(distance, fitness):
+    """
+    Vectorized alternative to compute_pareto for the two maximized objectives.
+    Flags the nondominated points, of identical points the last one is kept like the archive does,
+    so the flagged points in input order match the order of the compute_pareto front.
+    Runs in O(n log n).
+    """
+    distance = np.asarray(distance, dtype=float)
+    fitness = np.asarray(fitness, dtype=float)
+    mask = np.zeros(len(distance), dtype=bool)
+    if len(distance) == 0:
+        return mask
+
+    # Sort by decreasing distance, then decreasing fitness, then last occurrence first
+    order = np.lexsort((-np.arange(len(distance)), -fitness, -distance))
+    sorted_fitness = fitness[order]
+    best = np.maximum.accumulate(sorted_fitness)
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = sorted_fitness[1:] > best[:-1]
+    mask[order[keep]] = True
+
+    return mask
+
+def box_front_size(objectives, epsilons, chunk=256):
+    """
+    Number of solutions an archive with these epsilons keeps of the
+    objectives, the number of nondominated epsilon boxes.  Minimization
+    is assumed.
+    objectives: n x objectives numpy array
+    epsilons: sizes of the epsilon boxes
+    """
+    boxes = np.unique(np.floor(objectives / np.asarray(epsilons)), axis=0)
+    size = 0
+    for b in range(0, len(boxes), chunk):
+        block = boxes[b:b + chunk]
+        # The boxes are distinct, a box is dominated when another box is smaller or equal in every objective
+        weakly = np.all(boxes[None, :, :] <= block[:, None, :], axis=2)
+        size += np.count_nonzero(np.count_nonzero(weakly, axis=1) == 1)
+
+    return size
+
+def bounded_front(distance, fitness, max_size, stats=None):
+    """
+    The pareto front of the two maximized objectives thinned out to a
+    well spread set of max_size points, see pareto_mask and Archive.
+    The two ends of the front are always kept, the largest fitness end
+    first when max_size is 1.  The other points are sorted into an
+    archive of max_size - 2 with coarsened epsilons.  The objectives are
+    taken relative to the corner of the front and scaled by its extent,
+    so the epsilon boxes do not depend on the offset of the objectives.
+    Slots the coarsening leaves free are filled with the points farthest
+    from the points kept.
+    stats: dictionary to report the final "epsilons", in the units of the
+           objectives, and the number of "coarsenings" in, ignored if None
+    Output:
+        boolean numpy array flagging the points that are kept
+    """
+    distance = np.asarray(distance, dtype=float)
+    fitness = np.asarray(fitness, dtype=float)
+    mask = np.zeros(len(distance), dtype=bool)
+    front = np.flatnonzero(pareto_mask(distance, fitness))
+    if stats is not None:
+        stats["epsilons"] = [1e-9, 1e-9]
+        stats["coarsenings"] = 0
+    if len(front) <= max_size:
+        mask[front] = True
+        return mask
+
+    # From the largest distance end to the largest fitness end of the front
+    front = front[np.argsort(-distance[front], kind="stable")]
+    points = np.column_stack((distance[front], fitness[front]))
+    extent = np.ptp(points, axis=0)
+    extent[extent == 0] = 1.0
+    points = (points - points.min(axis=0)) / extent
+
+    keep = [len(front) - 1, 0][:max_size]
+    if max_size > 2:
+        archive = Archive([1e-9, 1e-9], max_size - 2)
+        for p in range(1, len(front) - 1):
+            archive.sortinto([-points[p, 0], -points[p, 1]], p)
+        keep += archive.tagalongs
+        if stats is not None:
+            stats["epsilons"] = [float(eps) for eps in np.asarray(archive.epsilons) * extent]
+            stats["coarsenings"] = archive.coarsenings
+
+    gaps = np.min(np.linalg.norm(points[:, None, :] - points[keep][None, :, :], axis=2), axis=1)
+    while len(keep) < max_size:
+        p = int(np.argmax(gaps))
+        keep.append(p)
+        gaps = np.minimum(gaps, np.linalg.norm(points - points[p], axis=1))
+
+    mask[front[keep]] = True
+    return mask
@@ -0,0 +1,101 @@
+import numpy as np
+from pareto import pareto_mask
+
+def nondominated_front(points):
+    """
+    Extract the nondominated front of a set of two-objective points, both objectives are maximized.
+    Runs in O(n log n), see pareto.pareto_mask.
+    Input:
+        points: n x 2 array-like of (distance, fitness)
+    Output:
+        m x 2 numpy array of the front, sorted by decreasing distance
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    front = points[pareto_mask(points[:, 0], points[:, 1])]
+
+    return front[np.argsort(-front[:, 0], kind="stable")]
+
+def hypervolume(front, reference):
+    """
+    Area dominated by a two-objective front (maximization) and bounded by the reference point.
+    Input:
+        front: m x 2 numpy array as returned by nondominated_front
+        reference: (distance, fitness) point that is dominated by the whole front
+    Output:
+        hypervolume as a float
+    """
+    if len(front) == 0:
+        return 0.0
+    x = np.maximum(front[:, 0] - reference[0], 0.0)
+    y = np.maximum(front[:, 1] - reference[1], 0.0)
+    # Front is sorted by decreasing distance and increasing fitness, slice the area into rectangles
+    heights = np.diff(np.concatenate(([0.0], y)))
+
+    return float(np.sum(x * heights))
+
+def spread(front):
+    """
+    Deb's spread indicator over the consecutive gaps of the front.
+    0 means the points are evenly spaced, larger values mean a more clustered front.
+    """
+    if len(front) < 3:
+        return 0.0
+    gaps = np.linalg.norm(np.diff(front, axis=0), axis=1)
+    mean_gap = gaps.mean()
+    if mean_gap == 0:
+        return 0.0
+
+    return float(np.sum(np.abs(gaps - mean_gap)) / (len(gaps) * mean_gap))
+
+def front_quality(points, reference):
+    """
+    Compute the quality of the pareto front of the candidate solutions
+    Input:
+        points: n x 2 array-like of the (distance, fitness) of the candidate solutions
+        reference: (distance, fitness) reference point for the hypervolume
+    Output:
+        Dictionary with the hypervolume, spread and size of the front
+    """
+    front = nondominated_front(points)
+
+    return {
+        "hypervolume": hypervolume(front, reference),
+        "spread": spread(front),
+        "front_size": len(front),
+    }
+
+class QualityTracker(object):
+    """
+    Keeps a per-iteration trace of the front quality during ensemble construction,
+    and detects when the hypervolume has plateaued.
+    """
+    def __init__(self, reference, trace=None, patience=None, tol=1e-3):
+        """
+        reference: (distance, fitness) reference point for the hypervolume
+        trace:     list to append the per-iteration records to, a new list if None
+        patience:  number of iterations without relative hypervolume change larger than tol
+                   before reporting a plateau, never plateaus if None
+        """
+        self.reference = reference
+        self.trace = trace if trace is not None else []
+        self.patience = patience
+        self.tol = tol
+
+    def update(self, ensemble_size, points):
+        """ record the front quality of the current (distance, fitness) candidate points """
+        record = front_quality(points, self.reference)
+        record["iteration"] = ensemble_size
+        self.trace.append(record)
+
+        return record
+
+    def plateaued(self):
+        """ True if the hypervolume has not changed by more than tol in the last patience iterations """
+        if self.patience is None or len(self.trace) <= self.patience:
+            return False
+        last = [record["hypervolume"] for record in self.trace[-(self.patience + 1):]]
+        for previous, current in zip(last, last[1:]):
+            if abs(current - previous) > self.tol * max(abs(previous), 1e-12):
+                return False
+
+        return True
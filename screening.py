@@ -0,0 +1,175 @@
+import time
+import numpy as np
+
+CKA_METRICS = ("Kernel CKA", "Linear CKA")
+INT8_METRICS = ("L1", "L2", "dot-product")
+
+# Column block of the float32 products of int8 sketches. Every partial sum of a block is an integer
+# below 2**24 in magnitude, so the block sums are exact whatever order BLAS adds them in.
+PRODUCT_BLOCK = 1024
+
+def quantize_int8(weights, block=16):
+    """
+    Symmetric int8 quantization of a stack of matrices with one scale shared by all of them,
+    so distances between the quantized matrices can be computed in integer arithmetic.
+    Works through the matrices in blocks of rows, which keeps the float64 temporaries in cache.
+    Output:
+        Dictionary with the n x elements int8 "sketches", the "scale", and per matrix the sums of the
+        "squares" of the sketch, of the absolute residuals "abs_residuals", of the squared residuals
+        "squared_residuals" and of the squared weights "squared_weights"
+    """
+    weights = weights.reshape(len(weights), -1)
+    scale = float(np.abs(weights).max(initial=0)) / 127
+    if scale == 0:
+        scale = 1.0
+    result = {"sketches": np.empty(weights.shape, dtype=np.int8), "scale": scale}
+    for name in ("squares", "abs_residuals", "squared_residuals", "squared_weights"):
+        result[name] = np.empty(len(weights))
+    for b in range(0, len(weights), block):
+        mats = weights[b:b + block].astype(np.float64)
+        sketches = np.round(mats / scale)
+        residuals = mats - sketches * scale
+        result["sketches"][b:b + block] = sketches
+        result["squares"][b:b + block] = np.einsum("ij,ij->i", sketches, sketches)
+        result["abs_residuals"][b:b + block] = np.abs(residuals).sum(axis=1)
+        result["squared_residuals"][b:b + block] = np.einsum("ij,ij->i", residuals, residuals)
+        result["squared_weights"][b:b + block] = np.einsum("ij,ij->i", mats, mats)
+
+    return result
+
+def orthonormal_basis(vectors, rank, seed=0):
+    """
+    Leading right singular vectors of a random sample of the vectors
+    Output:
+        features x rank numpy array with orthonormal columns
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(vectors), min(len(vectors), max(4 * rank, 256)), replace=False)
+    _, _, vt = np.linalg.svd(vectors[np.sort(sample)], full_matrices=False)
+
+    return vt[:rank].T
+
+class SketchScreen(object):
+    """
+    Compact sketches of every solution, with lower and upper bounds on the exact distances computed from them.
+    The bounds always hold, and computing them for a row of candidates costs less than the exact row.
+    int8 (L1, L2, dot-product): the weights are quantized with one shared scale. Distances between the sketches are
+        computed with integer sums, and the quantization error of each sketch bounds the error of the distance.
+    lowrank (Kernel CKA, Linear CKA): CKA is the cosine between the centered kernels. The normalized kernels are
+        projected onto a rank dimensional orthonormal basis, and by Cauchy-Schwarz the projection residuals
+        bound the error of the cosine.
+    construct_ensamble uses the bounds to only compute exact distances for candidates that could still
+    be on the pareto front.
+    """
+    def __init__(self, solutions, distances, method=None, rank=64, seed=0):
+        """
+        solutions: SolutionSet of the genomes, the same as the solutions of distances
+        distances: DistanceCache of the exact distances. For the CKA metrics the sketches are built from its
+                   kernels, which are then shared with the exact distances
+        method: "int8" or "lowrank", int8 for L1, L2 and dot-product and lowrank for the CKA metrics if None
+        rank: number of dimensions of the lowrank projection
+        """
+        self.metric = distances.metric
+        if method is None:
+            method = "lowrank" if self.metric in CKA_METRICS else "int8"
+        if method not in ("int8", "lowrank"):
+            raise ValueError("Invalid sketch method")
+        if (method == "int8") != (self.metric in INT8_METRICS):
+            raise ValueError(f"{method} sketches are not supported for {self.metric}")
+        self.method = method
+
+        start = time.perf_counter()
+        ids = np.arange(len(solutions))
+        if method == "int8":
+            quantized = quantize_int8(solutions.weights)
+            self.sketches, self.scale, self.squares = quantized["sketches"], quantized["scale"], quantized["squares"]
+            elements = self.sketches.shape[1]
+            if self.metric != "L1":
+                # float32 copy in blocks for the BLAS products, see PRODUCT_BLOCK
+                padded = -elements % PRODUCT_BLOCK
+                self.products = np.pad(self.sketches, ((0, 0), (0, padded))).astype(np.float32)
+            self.l1_errors = quantized["abs_residuals"] / elements
+            self.rms_errors = np.sqrt(quantized["squared_residuals"] / elements)
+            self.norms = np.sqrt(quantized["squared_weights"])
+            self.residual_norms = np.sqrt(quantized["squared_residuals"])
+            self.sketch_norms = np.sqrt(self.squares) * self.scale
+        else:
+            # The kernels are computed once by the DistanceCache and reused by the exact distances,
+            # their cost is not part of the build time of the screen
+            kernel_start = time.perf_counter()
+            kernels, norms = distances.representations(ids)
+            if distances.feature_space:
+                kernels = np.matmul(kernels, kernels.transpose(0, 2, 1))
+            start += time.perf_counter() - kernel_start
+            vectors = kernels.reshape(len(solutions), -1) / norms[:, None]
+            basis = orthonormal_basis(vectors, min(rank, vectors.shape[1]), seed)
+            self.sketches = np.dot(vectors, basis)
+            self.residual_norms = np.linalg.norm(vectors - np.dot(self.sketches, basis.T), axis=1)
+        self.build_time = time.perf_counter() - start
+
+    def dot(self, i, ids):
+        """ exact integer dot products between the int8 sketch i and the sketches ids """
+        # Gathering most of the rows costs more than multiplying all of them
+        full = 2 * len(ids) > len(self.products)
+        rows = self.products if full else self.products[ids]
+        products = np.zeros(len(rows))
+        for b in range(0, rows.shape[1], PRODUCT_BLOCK):
+            products += np.dot(rows[:, b:b + PRODUCT_BLOCK], self.products[i, b:b + PRODUCT_BLOCK])
+        return products[ids] if full else products
+
+    def bounds(self, i, ids):
+        """
+        Lower and upper bounds on the exact distances between solution i and the solutions ids
+        Output:
+            Tuple of (lower, upper) numpy arrays
+        """
+        ids = np.asarray(ids, dtype=int)
+        if self.metric == "L1":
+            total = np.abs(np.subtract(self.sketches[ids], self.sketches[i], dtype=np.int16)).sum(axis=1, dtype=np.int64)
+            approx = total * self.scale / self.sketches.shape[1]
+            # Triangle inequality, with slack for the float32 rounding of the exact distances
+            error = self.l1_errors[i] + self.l1_errors[ids] + 1e-5 * approx
+            return np.maximum(approx - error, 0.0), approx + error
+        if self.method == "lowrank":
+            approx = np.dot(self.sketches[ids], self.sketches[i])
+            error = self.residual_norms[i] * self.residual_norms[ids] + 1e-9
+            return approx - error, approx + error
+
+        products = self.dot(i, ids)
+        if self.metric == "L2":
+            # The root mean squared difference is a metric, bound it by the triangle inequality
+            squares = np.maximum(self.squares[ids] + self.squares[i] - 2 * products, 0)
+            root = np.sqrt(squares / self.sketches.shape[1]) * self.scale
+            error = self.rms_errors[i] + self.rms_errors[ids]
+            lower = np.maximum(root - error, 0.0)**2
+            upper = (root + error)**2
+            return lower * (1 - 1e-5), upper * (1 + 1e-5)
+        # dot-product: <w_i, w_j> = <s_i, s_j> + <s_i, r_j> + <r_i, s_j> + <r_i, r_j> for sketches s and residuals r
+        approx = products * self.scale**2 / (self.norms[ids] * self.norms[i])
+        error = (self.sketch_norms[i] * self.residual_norms[ids] + self.residual_norms[i] * self.sketch_norms[ids]
+                 + self.residual_norms[i] * self.residual_norms[ids]) / (self.norms[ids] * self.norms[i]) + 1e-5
+        return approx - error, approx + error
+
+def possibly_optimal(lower, upper, fitness):
+    """
+    Flags the candidates that could be on the pareto front given bounds on their distance.
+    A candidate is ruled out if another candidate is guaranteed to be at least as far away and at least as fit,
+    the pessimistic distance of the other candidate must be strictly larger than the optimistic distance.
+    Runs in O(n log n).
+    Input:
+        lower, upper: numpy arrays with the bounds on the distance of each candidate
+        fitness: numpy array with the fitness of each candidate
+    Output:
+        boolean numpy array
+    """
+    order = np.argsort(-lower, kind="stable")
+    sorted_lower = -lower[order]
+    best_fitness = np.maximum.accumulate(fitness[order])
+
+    # Number of candidates whose pessimistic distance is strictly larger than the optimistic distance of each candidate
+    n_further = np.searchsorted(sorted_lower, -upper, side="left")
+    dominated = np.zeros(len(lower), dtype=bool)
+    has_further = n_further > 0
+    dominated[has_further] = best_fitness[n_further[has_further] - 1] >= fitness[has_further]
+
+    return ~dominated
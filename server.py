@@ -0,0 +1,231 @@
+import json
+import time
+import argparse
+import numpy as np
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from construct_ensamble import construct_ensamble
+from utils import get_solutoins, load_solutions, SolutionSet, DistanceCache, METRICS
+
+class PopulationStore(object):
+    """
+    The warm state of a single root directory: the directory scans, the loaded genomes
+    and a DistanceCache per metric shared by every request on this root directory.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.paths = OrderedDict() # (generation_st, generation_end) -> genome ids, least recently used first
+        self.solutions = load_solutions([]) # SolutionSet of the genomes loaded so far, grows on demand
+        self.ids = {}       # path -> genome id in self.solutions
+        self.caches = {}    # metric -> DistanceCache over self.solutions
+        self.lock = threading.RLock()
+
+    def get_solutions(self, generation_st, generation_end):
+        """
+        solutions of the generation range, only genomes that are not loaded yet are read from disk
+        Output:
+            Tuple of (SolutionSet, genome ids of the generation range)
+        """
+        with self.lock:
+            generations = (generation_st, generation_end)
+            if generations not in self.paths:
+                paths = get_solutoins(self.root_dir, generation_st, generation_end)
+                if not paths:
+                    raise ValueError(f"No genomes in generations {generation_st}-{generation_end} of {self.root_dir}")
+                missing = [path for path in paths if path not in self.ids]
+                # New genomes are appended, the ids of the loaded genomes and the caches stay valid
+                self.ids.update({path: len(self.solutions) + i for i, path in enumerate(missing)})
+                self.solutions = SolutionSet.concatenate(self.solutions, load_solutions(missing))
+                for cache in self.caches.values():
+                    cache.extend(self.solutions)
+                self.paths[generations] = np.array([self.ids[path] for path in paths], dtype=int)
+            self.paths.move_to_end(generations)
+
+            return self.solutions, self.paths[generations]
+
+    def drop_generations(self):
+        """
+        Forget the least recently used generation range and unload the genomes no other range uses.
+        The genome ids change, so the distance caches are cleared as well.
+        Output:
+            False if there was no generation range to drop
+        """
+        with self.lock:
+            if not self.paths:
+                return False
+            self.paths.popitem(last=False)
+            keep = np.unique(np.concatenate(list(self.paths.values()))) if self.paths else np.zeros(0, dtype=int)
+            remap = np.full(len(self.solutions), -1, dtype=int)
+            remap[keep] = np.arange(len(keep))
+            self.solutions = self.solutions.subset(keep) if len(keep) > 0 else load_solutions([])
+            self.ids = {path: i for i, path in enumerate(self.solutions.paths)}
+            self.paths = OrderedDict((generations, remap[ids]) for generations, ids in self.paths.items())
+            self.caches = {}
+
+            return True
+
+    def get_cache(self, metric):
+        with self.lock:
+            if metric not in self.caches:
+                self.caches[metric] = DistanceCache(self.solutions, metric)
+
+            return self.caches[metric]
+
+    def get(self, generation_st, generation_end, metric):
+        """
+        solutions, genome ids and distance cache taken together, they stay consistent with each other
+        when generations are dropped by a concurrent request
+        Output:
+            Tuple of (SolutionSet, genome ids of the generation range, DistanceCache)
+        """
+        with self.lock:
+            solutions, ids = self.get_solutions(generation_st, generation_end)
+            return solutions, ids, self.get_cache(metric)
+
+    def nbytes(self):
+        """ approximate memory held by the genomes and the caches """
+        with self.lock:
+            return self.solutions.nbytes() + sum(cache.nbytes() for cache in self.caches.values())
+
+class EnsembleService(object):
+    """
+    Keeps populations, CKA representations and distances in memory between ensemble requests.
+    When the memory budget is exceeded after a request, root directories are evicted least recently used first.
+    Within the last root directory the least recently used generation ranges are unloaded next, so the
+    budget covers the genomes as well as the distance caches.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.stores = OrderedDict() # root_dir -> PopulationStore, least recently used first
+        self.lock = threading.Lock()
+
+    def get_store(self, root_dir, generation_st, generation_end):
+        """
+        the store of root_dir, a new store is only kept once the generation range could be loaded
+        """
+        with self.lock:
+            store = self.stores.get(root_dir)
+        if store is None:
+            store = PopulationStore(root_dir)
+            store.get_solutions(generation_st, generation_end)
+        with self.lock:
+            store = self.stores.setdefault(root_dir, store)
+            self.stores.move_to_end(root_dir)
+
+        return store
+
+    def nbytes(self):
+        with self.lock:
+            stores = list(self.stores.values())
+        return sum(store.nbytes() for store in stores)
+
+    def evict(self):
+        """
+        drop least recently used root directories, then the least recently used generation ranges
+        of the last one, until under budget
+        """
+        with self.lock:
+            while len(self.stores) > 1 and sum(store.nbytes() for store in self.stores.values()) > self.max_bytes:
+                root_dir, store = self.stores.popitem(last=False)
+                print(f"Evicting {root_dir}")
+            for root_dir, store in list(self.stores.items()):
+                while store.nbytes() > self.max_bytes and store.drop_generations():
+                    print(f"Evicting the least recently used generations of {root_dir}")
+                if len(store.solutions) == 0:
+                    del self.stores[root_dir]
+
+    def build_ensemble(self, root_dir, generation_st, generation_end, k, metric="Kernel CKA"):
+        """
+        Build an ensemble of k solutions, see construct_ensamble
+        Output:
+            List of paths to the solutions in the ensemble
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Invalid metric {metric}")
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        store = self.get_store(root_dir, generation_st, generation_end)
+        solutions, ids, distances = store.get(generation_st, generation_end, metric)
+        ensemble = construct_ensamble(solutions, k, distances=distances, ids=ids)
+        self.evict()
+
+        return [solutions.paths[i] for i in ensemble]
+
+    def status(self):
+        with self.lock:
+            stores = list(self.stores.values())
+        return {
+            "memory": sum(store.nbytes() for store in stores),
+            "max_memory": self.max_bytes,
+            "populations": {store.root_dir: {"genomes": len(store.solutions),
+                                             "distances": {metric: len(cache) for metric, cache in store.caches.items()}}
+                            for store in stores},
+        }
+
+class EnsembleRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /ensemble  {"root_dir", "generation_st", "generation_end", "k", "metric"} -> {"ensemble", "elapsed"}
+    GET  /status    memory usage and the warm populations
+    """
+    service = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(200, self.service.status())
+
+    def do_POST(self):
+        if self.path != "/ensemble":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("The request must be a JSON object")
+            start = time.time()
+            ensemble = self.service.build_ensemble(request["root_dir"], int(request["generation_st"]),
+                                                   int(request["generation_end"]), int(request["k"]),
+                                                   request.get("metric", "Kernel CKA"))
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"ensemble": ensemble, "elapsed": time.time() - start})
+
+def serve(host="127.0.0.1", port=8765, max_memory_mb=1024):
+    """
+    Run the ensemble construction service on host:port until interrupted.
+    Requests are handled concurrently, each in its own thread.
+    """
+    EnsembleRequestHandler.service = EnsembleService(max_memory_mb * 1024 * 1024)
+    server = ThreadingHTTPServer((host, port), EnsembleRequestHandler)
+    print(f"Serving ensemble requests on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm ensemble construction service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-memory-mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.max_memory_mb)
@@ -1,11 +1,13 @@
 import os
 import shutil
 import re
-from tqdm import tqdm
-import torch
+import threading
+import pickle
+import zipfile
 import numpy as np
-from pareto import compute_pareto
-from cka import linear_CKA, kernel_CKA
+from checkpoint import read_checkpoint
+from pareto import pareto_mask, bounded_front
+from cka import linear_CKA, kernel_CKA, kernel_representation, linear_representation, linear_feature_representation, use_feature_space
 
 def get_solutoins(root_dir, generation_st, generation_end):
     """
@@ -18,11 +20,11 @@ def get_solutoins(root_dir, generation_st, generation_end):
     Output:
         list of paths to the solutions
     """
+    from tqdm import tqdm
     if not os.path.exists(root_dir):
         raise ValueError("The root directory does not exist")
     solution_paths = []
-    subfolders = os.listdir(root_dir)
-    subfolders.sort(key=lambda x: int(re.findall(r"\d+", x)[0]))
+    subfolders = population_folders(root_dir)
     for i, subfolder in enumerate(tqdm(subfolders, desc="fetching genomes from populations")):
         if i >= generation_st and i <= generation_end:
             print(f"Fetching genomes from {subfolder}")
@@ -33,6 +35,16 @@ def get_solutoins(root_dir, generation_st, generation_end):
 
     return solution_paths
 
+def population_folders(root_dir):
+    """
+    population folders of the root directory in generation order, the generation index is the position.
+    Entries without a number in their name and files are not populations and are skipped
+    """
+    subfolders = [x for x in os.listdir(root_dir)
+                  if re.search(r"\d+", x) and os.path.isdir(os.path.join(root_dir, x))]
+    subfolders.sort(key=lambda x: int(re.findall(r"\d+", x)[0]))
+    return subfolders
+
 def save_ensemble(solution_paths, dst):
     """
     Saves the optimal solutions to the destination directory
@@ -40,6 +52,7 @@ def save_ensemble(solution_paths, dst):
         solution_paths: list of paths to the optimal solutions
         dst: root destination directory
     """
+    from tqdm import tqdm
     if not os.path.exists(dst):
         print(f"Destination folder {dst} does not exist. Creating it.")
         os.makedirs(dst)
@@ -61,47 +74,166 @@ def save_ensemble(solution_paths, dst):
     for i, solution in enumerate(tqdm(solution_paths, desc="Copying genomes to destination folder")):
         shutil.copy(solution, os.path.join(dst, f"genome_{i}.pth"))
 
+class SolutionSet(object):
+    """
+    Struct-of-arrays container for a population of solutions.
+    Solutions are identified by integer ids, the position in the arrays.
+    The weight matrices are stacked into one contiguous array, the paths are kept apart from the numerical data.
+    Supports the dictionary access used throughout the code, keys() are the ids and
+    solutions[id] is the tuple (weight_matrix, fitness).
+    """
+    __slots__ = ("weights", "fitness", "generations", "paths")
+
+    def __init__(self, weights, fitness, generations, paths):
+        """
+        weights: n x rows x columns array of the weight matrices
+        fitness: array of n fitness values
+        generations: array of n generation indices as used by get_solutoins, -1 if unknown
+        paths: list of n paths to the solutions
+        """
+        self.weights = weights
+        self.fitness = fitness
+        self.generations = generations
+        self.paths = paths
+
+    @classmethod
+    def from_dict(cls, solutions):
+        """ convert a dictionary of solutions, the keys are kept as the paths """
+        paths = list(solutions.keys())
+        weights = np.stack([np.asarray(solutions[key][0], dtype=np.float32) for key in paths])
+        fitness = np.array([solutions[key][1] for key in paths], dtype=float)
+        return cls(weights, fitness, get_generations(paths), paths)
+
+    @classmethod
+    def concatenate(cls, first, second):
+        """ append the solutions of second to first, the ids of first are kept """
+        if len(first) == 0:
+            return second
+        if len(second) == 0:
+            return first
+        return cls(np.concatenate((first.weights, second.weights)),
+                   np.concatenate((first.fitness, second.fitness)),
+                   np.concatenate((first.generations, second.generations)),
+                   first.paths + second.paths)
+
+    def __len__(self):
+        return len(self.fitness)
+
+    def __getitem__(self, i):
+        return (self.weights[i], self.fitness[i])
+
+    def keys(self):
+        return range(len(self))
+
+    def ids_of(self, paths):
+        """ ids of the given paths """
+        index = {path: i for i, path in enumerate(self.paths)}
+        return np.array([index[path] for path in paths], dtype=int)
+
+    def subset(self, ids):
+        """ the solutions ids as a new SolutionSet, the solution ids[i] gets id i """
+        return SolutionSet(self.weights[ids], self.fitness[ids], self.generations[ids], [self.paths[i] for i in ids])
+
+    def nbytes(self):
+        return self.weights.nbytes + self.fitness.nbytes + self.generations.nbytes
+
+def as_solution_set(solutions):
+    """ return solutions as a SolutionSet, dictionaries of solutions are converted """
+    if isinstance(solutions, SolutionSet):
+        return solutions
+    return SolutionSet.from_dict(solutions)
+
+def get_generations(solution_paths):
+    """
+    generation index of every solution, the position of its population folder in the root directory
+    as used by the generation_st and generation_end of get_solutoins
+    Output:
+        numpy array of generation indices, -1 where the path is not a file in a population folder
+    """
+    indices = {} # root directory -> population folder -> generation index
+    generations = np.full(len(solution_paths), -1, dtype=int)
+    for i, solution_path in enumerate(solution_paths):
+        # Keys of dictionaries of solutions need not be paths
+        if not isinstance(solution_path, (str, os.PathLike)) or not os.path.isfile(solution_path):
+            continue
+        folder = os.path.dirname(str(solution_path))
+        root_dir = os.path.dirname(folder)
+        if root_dir not in indices:
+            try:
+                indices[root_dir] = {subfolder: g for g, subfolder in enumerate(population_folders(root_dir or "."))}
+            except OSError:
+                indices[root_dir] = {}
+        generations[i] = indices[root_dir].get(os.path.basename(folder), -1)
+
+    return generations
+
+def load_solution(solution_path):
+    """
+    Load the weights and the fitness of a single solution. Checkpoints in the zip format are read without torch,
+    torch is only imported for the legacy format or when the checkpoint holds objects the reader does not know.
+    Output:
+        Tuple of (weight_matrix, fitness)
+    """
+    try:
+        return read_checkpoint(solution_path, "_submodules.0.weight")
+    except (zipfile.BadZipFile, pickle.UnpicklingError, StopIteration, KeyError):
+        import torch
+        layer = torch.load(solution_path, map_location=torch.device('cpu'))
+        return layer["state_dict"]["_submodules.0.weight"].numpy(), layer["fitness"]
+
 def load_solutions(solution_paths):
     """
     Load the solution weights from the solution paths
     Input:
         solution_paths: list of paths to the solutions
     Output:
-        Dictionary of solutions with the index as the key and the solution weight matrix as the value
+        SolutionSet of the solutions, the ids follow the order of solution_paths
     """
     #fitness_scalar = lambda x: ((x + 1) / 2) * 100
     fitness_scalar = lambda x: x
-    solutions = {}
+    weights = []
+    fitness = []
     for solution_path in solution_paths:
-        layer = torch.load(solution_path, map_location=torch.device('cpu'))
-        solutions[solution_path] = (layer["state_dict"]["_submodules.0.weight"], fitness_scalar(layer["fitness"]))
+        weight_matrix, solution_fitness = load_solution(solution_path)
+        weights.append(weight_matrix)
+        fitness.append(fitness_scalar(solution_fitness))
 
-    return solutions
+    weights = np.stack(weights) if weights else np.zeros((0, 0, 0), dtype=np.float32)
+    return SolutionSet(weights, np.array(fitness, dtype=float), get_generations(solution_paths), list(solution_paths))
 
 def get_reference_solution(solutions):
     """
     Gets the best performing solution from the hash table of solutions
 
     Input:
-        solutions: dictionary of solutions
+        solutions: SolutionSet or dictionary of solutions
             key: path to solution
             value: tuple of (weight_matridx, fitness)
 
     Output:
         The best performing solution, returned as a tuple of (key, value)
     """
-    key = max(solutions, key=lambda x: solutions[x][1])
+    if isinstance(solutions, SolutionSet):
+        key = int(np.argmax(solutions.fitness))
+    else:
+        key = max(solutions, key=lambda x: solutions[x][1])
 
     return (key, solutions[key])
 
+METRICS = ("L1", "L2", "dot-product", "Linear CKA", "Kernel CKA")
+# Smallest distance of each metric, the dot-product is a cosine and the others are non-negative
+METRIC_LOWER_BOUNDS = {"L1": 0.0, "L2": 0.0, "dot-product": -1.0, "Linear CKA": 0.0, "Kernel CKA": 0.0}
+
 def compute_distance(mat1, mat2, metric="Kernel CKA"):
     """
     Compute the mean squared error between two matrices
     """
+    mat1 = np.asarray(mat1)
+    mat2 = np.asarray(mat2)
     if metric == "L1":
-        return (mat1 - mat2).abs().mean().item()
+        return float(np.mean(np.abs(mat1 - mat2)))
     if metric == "L2":
-        return ((mat1 - mat2)**2).mean().item()
+        return float(np.mean((mat1 - mat2)**2))
     elif metric == "dot-product":
         d = np.dot(mat1.flatten(), mat2.flatten())
         d /= (np.linalg.norm(mat1) * np.linalg.norm(mat2))
@@ -114,7 +246,182 @@ def compute_distance(mat1, mat2, metric="Kernel CKA"):
     else:
         raise ValueError("Invalid metric")
 
-def get_optimal_solution(candidate_solutions, included, n):
+def compute_distances(mat, mats, metric):
+    """
+    Vectorized compute_distance between one matrix and a stack of matrices, for the metrics that
+    do not need a kernel representation
+    Output:
+        numpy array with one distance per matrix in mats
+    """
+    if metric == "L1":
+        return np.abs(mats - mat).mean(axis=(1, 2))
+    if metric == "L2":
+        return ((mats - mat)**2).mean(axis=(1, 2))
+    elif metric == "dot-product":
+        flat = mats.reshape(len(mats), -1)
+        d = np.dot(flat, mat.flatten())
+        return d / (np.linalg.norm(flat, axis=1) * np.linalg.norm(mat))
+    else:
+        raise ValueError("Invalid metric")
+
+def compute_distance_map(solutions, keys=None, metric="Kernel CKA", distances=None):
+    """
+    Compute the pairwise distance map between the given solutions.
+    The distance is symmetric, so only the upper triangle is computed and mirrored.
+    Input:
+        solutions: SolutionSet or dictionary of solutions
+            key: path to solution
+            value: tuple of (weight_matrix, fitness)
+        keys: list of keys to include in the map, if None all solutions are used
+        metric: distance metric passed on to compute_distance
+        distances: DistanceCache to take the distances from, a new one for the metric if None
+    Output:
+        len(keys) x len(keys) numpy array of distances
+    """
+    if keys is None:
+        keys = list(solutions.keys())
+    if isinstance(solutions, SolutionSet):
+        ids = np.asarray(keys, dtype=int)
+    else:
+        index = {key: i for i, key in enumerate(solutions.keys())}
+        ids = np.array([index[key] for key in keys], dtype=int)
+    if distances is None:
+        distances = DistanceCache(solutions, metric)
+
+    distance_map = np.zeros((len(ids), len(ids)))
+    for i in range(len(ids)):
+        distance_map[i, i:] = distances.row(ids[i], ids[i:])
+        distance_map[i:, i] = distance_map[i, i:]
+
+    return distance_map
+
+class DistanceCache(object):
+    """
+    Memoizes the distances between solutions so they can be shared between ensemble constructions.
+    Distances are stored per row, one array for every solution that distances were requested from,
+    which keeps the greedy selection to k rows instead of a full distance matrix.
+    The distance is symmetric, a distance already stored in the row of the other solution is reused.
+    Lookups are safe to share between threads, at worst a distance is computed twice by concurrent callers.
+    The kernels and their norms are grown and written under a lock, so they always stay in step.
+    """
+    def __init__(self, solutions, metric="Kernel CKA"):
+        """
+        solutions: SolutionSet or dictionary of solutions
+            key: path to solution
+            value: tuple of (weight_matrix, fitness)
+        metric: distance metric passed on to compute_distance
+        """
+        self.solutions = as_solution_set(solutions)
+        self.metric = metric
+        self.rows = {}       # id -> array of distances to every solution, nan where not computed yet
+        self.kernels = None  # stacked centered kernels of the solutions for the CKA metrics
+        self.feature_space = False
+        self.norms = None    # Frobenius norms of the kernels, nan where the kernel is not computed yet
+        self.lock = threading.Lock() # guards growing self.kernels and self.norms and writing into them
+
+    def extend(self, solutions):
+        """ switch to a larger SolutionSet, the ids of the current solutions must be unchanged """
+        self.solutions = solutions
+
+    def weights(self, ids):
+        """ weight matrices used to compute the distances """
+        return self.solutions.weights[ids]
+
+    def representations(self, ids):
+        """
+        centered kernels of the solutions ids, each is computed once and reused for every pair it is part of.
+        For Linear CKA on matrices with few columns the centered weight matrices are kept instead, see cka.use_feature_space
+        """
+        with self.lock:
+            n = len(self.solutions)
+            if self.kernels is None or len(self.kernels) < n:
+                rows, columns = self.weights([0]).shape[1:]
+                self.feature_space = self.metric == "Linear CKA" and use_feature_space(rows, columns, columns)
+                shape = (n, rows, columns) if self.feature_space else (n, rows, rows)
+                kernels = np.zeros(shape)
+                norms = np.full(n, np.nan)
+                if self.kernels is not None:
+                    kernels[:len(self.kernels)] = self.kernels
+                    norms[:len(self.norms)] = self.norms
+                self.kernels, self.norms = kernels, norms
+            missing = np.unique(ids[np.isnan(self.norms[ids])])
+
+        # The kernels are computed outside the lock and published together with their norms
+        computed = []
+        for i in missing:
+            mat = self.weights([i])[0]
+            if self.metric == "Kernel CKA":
+                kernel = kernel_representation(mat)
+            elif self.feature_space:
+                kernel = linear_feature_representation(mat)
+            else:
+                kernel = linear_representation(mat)
+            if self.feature_space:
+                norm = np.linalg.norm(np.dot(kernel.T, kernel))
+            else:
+                norm = np.sqrt(np.sum(kernel * kernel))
+            computed.append((i, kernel, norm))
+
+        with self.lock:
+            for i, kernel, norm in computed:
+                self.kernels[i] = kernel
+                self.norms[i] = norm
+            return self.kernels[ids], self.norms[ids]
+
+    def compute(self, i, ids):
+        """ distances between solution i and the solutions ids, without the cache """
+        if self.metric in ("Kernel CKA", "Linear CKA"):
+            kernels, norms = self.representations(np.append(ids, i))
+            if self.feature_space:
+                hsic = np.sum(np.matmul(kernels[:-1].transpose(0, 2, 1), kernels[-1]) ** 2, axis=(1, 2))
+            else:
+                hsic = np.sum(kernels[:-1] * kernels[-1], axis=(1, 2))
+            return hsic / (norms[:-1] * norms[-1])
+        return compute_distances(self.weights([i])[0], self.weights(ids), self.metric)
+
+    def row(self, i, ids):
+        """ distances between solution i and the solutions ids """
+        i = int(i)
+        ids = np.asarray(ids, dtype=int)
+        row = self.rows.get(i)
+        if row is None or len(row) < len(self.solutions):
+            grown = np.full(len(self.solutions), np.nan)
+            if row is not None:
+                grown[:len(row)] = row
+            else:
+                # Reuse the distances stored in the rows of the other solutions
+                for j, other in list(self.rows.items()):
+                    if i < len(other):
+                        grown[j] = other[i]
+            row = grown
+            self.rows[i] = row
+
+        missing = ids[np.isnan(row[ids])]
+        if len(missing) > 0:
+            row[missing] = self.compute(i, missing)
+            # Mirror the new distances into the stored rows of the solutions missing
+            owners = np.fromiter(list(self.rows.keys()), dtype=int)
+            for j in owners[np.isin(owners, missing)]:
+                other = self.rows[j]
+                if j != i and i < len(other) and np.isnan(other[i]):
+                    other[i] = row[j]
+
+        return row[ids]
+
+    def get(self, i, j):
+        """ distance between the solutions i and j """
+        return float(self.row(i, [j])[0])
+
+    def nbytes(self):
+        """ approximate memory held by the cached distances and representations """
+        rows = sum(row.nbytes for row in list(self.rows.values()))
+        return rows + (self.kernels.nbytes if self.kernels is not None else 0)
+
+    def __len__(self):
+        """ number of distances computed """
+        return int(sum(np.count_nonzero(~np.isnan(row)) for row in list(self.rows.values())))
+
+def get_optimal_solution(candidate_solutions, included, n, max_front=None):
     """
     Given a set of solutions, and a set of candidate solution metrics, return the next optimal solution
     input:
@@ -123,17 +430,21 @@ def get_optimal_solution(candidate_solutions, included, n):
             value: tuple of (distance, fitness)
         included: hash table of included solutions
         n: number of solutions to include
+        max_front: optional maximum size of the pareto front, see pareto.bounded_front
     output:
         list of optimal solutions
     """
+    keys = list(candidate_solutions.keys())
+    values = np.array([candidate_solutions[key] for key in keys], dtype=float).reshape(-1, 2)
+    if max_front is None:
+        pareto_front = np.flatnonzero(pareto_mask(values[:, 0], values[:, 1]))
+    else:
+        pareto_front = np.flatnonzero(bounded_front(values[:, 0], values[:, 1], max_front))
+
     optimal_solutions = []
-    pareto_front = compute_pareto(candidate_solutions)
-    cnt = 0
-    for optimal_solution in pareto_front:
-        if cnt >= n: break
-        optimal_d, optimal_fitness, key = optimal_solution
-        if key not in included:
-            optimal_solutions.append(key)
-            cnt += 1
+    for i in pareto_front:
+        if len(optimal_solutions) >= n: break
+        if keys[i] not in included:
+            optimal_solutions.append(keys[i])
 
     return optimal_solutions
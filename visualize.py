@@ -1,7 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.manifold import MDS
-from utils import compute_distance
+from concurrent.futures import ProcessPoolExecutor
+from utils import compute_distance_map
 import os
 
 def visualize_pareto_front(candidate_solutions, optimal_solutions, iteration):
@@ -21,14 +22,7 @@ def visualize_pareto_front(candidate_solutions, optimal_solutions, iteration):
 
 def visualize_population(solutions):
     # Visualize the entire population using MDS
-    distance_map = np.zeros((len(solutions), len(solutions)))
-
-    for i, key1 in enumerate(solutions.keys()):
-        for j, key2 in enumerate(solutions.keys()):
-            distance_map[i][j] = compute_distance(solutions[key1][0], solutions[key2][0])
-
-    mds = MDS(n_components=2, dissimilarity="precomputed")
-    embedding = mds.fit_transform(distance_map)
+    distance_map, embedding = embed_population(solutions)
     # Get color based on the fitness
     fitness = [solutions[key][1] for key in solutions.keys()]
     v_min = min(fitness); v_max = max(fitness)
@@ -43,10 +37,7 @@ def visualize_population(solutions):
 
 def visualize_ensemble(solutions, ensemble_set):
     # Visualize ensemble using MDS
-    distance_map = np.zeros((len(ensemble_set), len(ensemble_set)))
-    for i, key1 in enumerate(ensemble_set):
-        for j, key2 in enumerate(ensemble_set):
-            distance_map[i][j] = compute_distance(solutions[key1][0], solutions[key2][0])
+    distance_map = compute_distance_map(solutions, ensemble_set)
 
     #plt.imshow(distance_map, cmap="hot", interpolation="nearest")
     #plt.show()
@@ -65,42 +56,48 @@ def visualize_ensemble(solutions, ensemble_set):
     plt.title("Parameter space embedding of ensemble solutions")
     plt.show()
 
-def combine_plots(solutions, ensemble, candidate_solutions, optimal_solutions, included, iteration, dst_path):
+def embed_population(solutions, metric="Kernel CKA", distances=None):
     """
-    Combines the ensemble plot, population plot, and pareto front plot into a single figure per iteration
-    Will be used to create a gif of the optimization process
-    All of the frames will be saved in the dst_path
+    Compute the population distance map and its MDS embedding.
+    The population does not change during ensemble selection, so this only has to be done once per animation.
+    distances: optional DistanceCache to take the distances from, e.g. a distributed.RemoteDistanceCache
+    Output:
+        Tuple of (distance_map, embedding), the rows follow the order of solutions.keys()
     """
-    if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
-    all_fitness = [solutions[key][1] for key in solutions.keys()]
-    v_min, v_max = min(all_fitness), max(all_fitness)
-
-    # Get the ensemble embedding
-    distance_map = np.zeros((len(ensemble), len(ensemble)))
-    for i, key1 in enumerate(ensemble):
-        for j, key2 in enumerate(ensemble):
-            distance_map[i][j] = compute_distance(solutions[key1][0], solutions[key2][0])
-
+    distance_map = compute_distance_map(solutions, metric=metric, distances=distances)
     mds = MDS(n_components=2, dissimilarity="precomputed")
-    ens_embedding = mds.fit_transform(distance_map)
-    ens_fitness = [solutions[key][1] for key in ensemble]
-
-    # Get the population embedding
-    distance_map = np.zeros((len(solutions), len(solutions)))
-    for i, key1 in enumerate(solutions.keys()):
-        for j, key2 in enumerate(solutions.keys()):
-            distance_map[i][j] = compute_distance(solutions[key1][0], solutions[key2][0])
+    embedding = mds.fit_transform(distance_map)
 
-    mds = MDS(n_components=2, dissimilarity="precomputed")
-    pop_embedding = mds.fit_transform(distance_map)
+    return distance_map, embedding
 
-    # Get the pareto front
-    candidate_solutions_x = [candidate_solutions[key][0] for key in candidate_solutions.keys()]
-    candidate_solutions_y = [candidate_solutions[key][1] for key in candidate_solutions.keys()]
+def _frame_data(solutions, ensemble, candidate_solutions, optimal_solutions, iteration, distance_map, index):
+    """
+    Extract the plain numerical data needed to draw a single frame.
+    The ensemble distances are taken from the cached population distance map instead of being recomputed.
+    """
+    ens_index = [index[key] for key in ensemble]
+    return {
+        "iteration": iteration,
+        "ens_distance": distance_map[np.ix_(ens_index, ens_index)],
+        "ens_fitness": [solutions[key][1] for key in ensemble],
+        "candidate_x": [candidate_solutions[key][0] for key in candidate_solutions.keys()],
+        "candidate_y": [candidate_solutions[key][1] for key in candidate_solutions.keys()],
+        "optimal_x": [candidate_solutions[key][0] for key in optimal_solutions],
+        "optimal_y": [candidate_solutions[key][1] for key in optimal_solutions],
+    }
+
+def _draw_frame(pop_embedding, all_fitness, frame):
+    """
+    Draw the population, ensemble and pareto front panels of a single frame, returns the figure
+    """
+    v_min, v_max = min(all_fitness), max(all_fitness)
+    iteration = frame["iteration"]
 
-    optimal_solutions_x = [candidate_solutions[key][0] for key in optimal_solutions]
-    optimal_solutions_y = [candidate_solutions[key][1] for key in optimal_solutions]
+    if len(frame["ens_fitness"]) > 1:
+        mds = MDS(n_components=2, dissimilarity="precomputed")
+        ens_embedding = mds.fit_transform(frame["ens_distance"])
+    else:
+        ens_embedding = np.zeros((len(frame["ens_fitness"]), 2))
 
     fig, ax = plt.subplots(1, 3, figsize=(15, 5))
 
@@ -117,18 +114,92 @@ def combine_plots(solutions, ensemble, candidate_solutions, optimal_solutions, i
     ax[0].set_title("Parameter space embedding of candidate solutions")
 
     # Plot the ensemble embedding
-    ax[1].scatter(ens_embedding[:, 0], ens_embedding[:, 1], c=ens_fitness, vmin=v_min, vmax=v_max, cmap="viridis")
+    ax[1].scatter(ens_embedding[:, 0], ens_embedding[:, 1], c=frame["ens_fitness"], vmin=v_min, vmax=v_max, cmap="viridis")
     ax[1].set_xlabel("mds 1")
     ax[1].set_ylabel("mds 2")
     ax[1].set_title("Parameter space embedding of ensemble")
 
 
     # Plot the pareto front
-    ax[2].scatter(candidate_solutions_x, candidate_solutions_y, label="Candidate solutions")
-    ax[2].scatter(optimal_solutions_x, optimal_solutions_y, color="red", label="Optimal solutions")
+    ax[2].scatter(frame["candidate_x"], frame["candidate_y"], label="Candidate solutions")
+    ax[2].scatter(frame["optimal_x"], frame["optimal_y"], color="red", label="Optimal solutions")
     ax[2].set_xlabel("Distance")
     ax[2].set_ylabel("Fitness")
     ax[2].set_title(f"Pareto front of candidate solutions itr={iteration}")
     ax[2].legend()
 
+    return fig
+
+def _init_render_worker():
+    # Frames are rendered off-screen, never through an interactive backend
+    plt.switch_backend("Agg")
+
+def _render_frame(args):
+    """
+    Render a single frame to an RGB array. Runs in a worker process.
+    """
+    pop_embedding, all_fitness, frame = args
+    fig = _draw_frame(pop_embedding, all_fitness, frame)
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+
+    return image
+
+def combine_plots(solutions, ensemble, candidate_solutions, optimal_solutions, included, iteration, dst_path, population=None):
+    """
+    Combines the ensemble plot, population plot, and pareto front plot into a single figure per iteration
+    Will be used to create a gif of the optimization process
+    All of the frames will be saved in the dst_path
+    population: optional (distance_map, embedding) tuple from embed_population, computed if not given
+    """
+    if not os.path.exists(dst_path):
+        os.makedirs(dst_path)
+    if population is None:
+        population = embed_population(solutions)
+    distance_map, pop_embedding = population
+    index = {key: i for i, key in enumerate(solutions.keys())}
+    all_fitness = [solutions[key][1] for key in solutions.keys()]
+
+    frame = _frame_data(solutions, ensemble, candidate_solutions, optimal_solutions, iteration, distance_map, index)
+    fig = _draw_frame(pop_embedding, all_fitness, frame)
+
     plt.savefig(f"{dst_path}/iteration_{iteration}.png")
+    plt.close(fig)
+
+def animate_selection(solutions, history, dst, fps=2, workers=None, metric="Kernel CKA", distances=None):
+    """
+    Render the ensemble selection process into an animation.
+    The population embedding is computed once, only the ensemble and pareto front panels change per iteration.
+    Frames are rendered in a process pool with the Agg backend and streamed into the writer in order.
+    Input:
+        solutions: SolutionSet or dictionary of solutions, the same as passed to construct_ensamble
+            key: genome id for a SolutionSet, path to solution for a dictionary
+            value: tuple of (weight_matrix, fitness)
+        history: list of (ensemble, candidate_solutions, optimal_solutions) tuples, as recorded by construct_ensamble
+        dst: path of the animation, the format (.gif or .mp4) is inferred from the extension
+        fps: frames per second of the animation
+        workers: number of rendering processes, defaults to the number of cpus
+        distances: optional DistanceCache to take the population distances from
+    """
+    import imageio
+
+    distance_map, pop_embedding = embed_population(solutions, metric, distances)
+    index = {key: i for i, key in enumerate(solutions.keys())}
+    all_fitness = [solutions[key][1] for key in solutions.keys()]
+
+    # Only numerical data is sent to the workers, the weight matrices stay in this process
+    frames = [(pop_embedding, all_fitness, _frame_data(solutions, ensemble, candidate_solutions, optimal_solutions, len(ensemble), distance_map, index))
+              for ensemble, candidate_solutions, optimal_solutions in history]
+
+    dst_dir = os.path.dirname(dst)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    if dst.lower().endswith(".gif"):
+        writer = imageio.get_writer(dst, mode="I", duration=1000 / fps, loop=0)
+    else:
+        writer = imageio.get_writer(dst, fps=fps)
+
+    with writer, ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as executor:
+        for image in executor.map(_render_frame, frames):
+            writer.append_data(image)